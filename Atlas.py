@@ -0,0 +1,271 @@
+import gpu
+import numpy as np
+from collections import namedtuple, OrderedDict
+from gpu_extras.batch import batch_for_shader
+from PIL import Image, ImageDraw
+from . Metrics import load_font
+from . Layout import FONT_ROLES
+
+
+# Width and height of the atlas texture, in pixels
+ATLAS_SIZE = 1024
+
+# Empty texels around every glyph, so filtering never reaches
+# into its neighbours
+PADDING = 1
+
+# Layouts whose glyphs share one set of batches
+BATCH_LINES = 128
+
+# Most sets of batches kept, least recently drawn are dropped first
+MAX_BATCH_SETS = 48
+
+Glyph = namedtuple('Glyph', [
+    'left',    # x of the bitmap from the pen position
+    'top',     # y of the top of the bitmap from the baseline, going down
+    'width',   # width of the bitmap in pixels
+    'height',  # height of the bitmap in pixels
+    'u',       # x of the bitmap in the atlas, in texels
+    'v',       # y of the bottom of the bitmap in the atlas, in texels
+])
+
+
+# Every glyph drawn, rasterized with PIL from the same font files the
+# layout is measured with, in a single texture. Glyphs are packed in
+# shelves, rows as tall as the tallest glyph in them, and the texture
+# is only uploaded again after glyphs were added. A full atlas starts
+# over, batches made with glyphs from before are made again.
+class GlyphAtlas:
+    def __init__(self, size=ATLAS_SIZE):
+        self.size = size
+
+        self.coverage = np.zeros((size, size), dtype=np.float32)
+        # alpha of every texel, rows going up from the bottom
+
+        self.glyphs = {}
+        # key : value
+        # (font path, size, character) : Glyph, None if nothing is drawn
+
+        # Where the next glyph goes
+        self.shelf_x = 0
+        self.shelf_y = 0
+        self.shelf_height = 0
+
+        # Bumped every time the atlas starts over
+        self.generation = 0
+
+        self.texture = None
+        self.dirty = False
+
+    def glyph(self, font_path, size, char):
+        key = (font_path, size, char)
+        if key not in self.glyphs:
+            self.glyphs[key] = self.rasterize(font_path, size, char)
+        return self.glyphs[key]
+
+    def rasterize(self, font_path, size, char):
+        if char.isspace():
+            return None
+        font = load_font(font_path, size)
+        left, top, right, bottom = font.getbbox(char, anchor='ls')
+        width = right - left
+        height = bottom - top
+        if width <= 0 or height <= 0:
+            return None
+        if max(width, height) + PADDING > self.size:
+            # Could never fit, even in an empty atlas
+            return None
+
+        image = Image.new('L', (width, height))
+        draw = ImageDraw.Draw(image)
+        draw.text((-left, -top), char, font=font, fill=255, anchor='ls')
+        # Textures start at the bottom left
+        bitmap = np.asarray(image, dtype=np.float32)[::-1] / 255
+
+        u, v = self.allocate(width, height)
+        self.coverage[v:v + height, u:u + width] = bitmap
+        self.dirty = True
+        return Glyph(left, top, width, height, u, v)
+
+    def allocate(self, width, height):
+        width += PADDING
+        height += PADDING
+        if self.shelf_x + width > self.size:
+            self.shelf_x = 0
+            self.shelf_y += self.shelf_height
+            self.shelf_height = 0
+        if self.shelf_y + height > self.size:
+            self.clear()
+        u = self.shelf_x
+        v = self.shelf_y
+        self.shelf_x += width
+        self.shelf_height = max(self.shelf_height, height)
+        return u, v
+
+    # Start over with an empty atlas
+    def clear(self):
+        self.coverage[:] = 0
+        self.glyphs.clear()
+        self.shelf_x = 0
+        self.shelf_y = 0
+        self.shelf_height = 0
+        self.generation += 1
+        self.dirty = True
+
+    # Texture of the atlas, uploaded again if glyphs were added
+    # Main thread only
+    def get_texture(self):
+        if self.texture is None or self.dirty:
+            # White everywhere, the glyphs are in the alpha channel
+            # and take their color from the shader
+            pixels = np.ones((self.size, self.size, 4), dtype=np.float32)
+            pixels[:, :, 3] = self.coverage
+            pixels = pixels.ravel()
+            buffer = gpu.types.Buffer('FLOAT', len(pixels), pixels)
+            self.texture = gpu.types.GPUTexture(
+                (self.size, self.size),
+                format='RGBA8',
+                data=buffer
+            )
+            self.dirty = False
+        return self.texture
+
+    def reset(self):
+        self.clear()
+        self.texture = None
+        self.dirty = False
+        self.generation = 0
+
+
+glyph_atlas = GlyphAtlas()
+
+
+# Batches of glyph quads for the spans of one SpanTable, a set for
+# every BATCH_LINES layouts and one batch per color role in a set
+# Quads are in document coordinates, going down from the top, so
+# scrolling and scaling only change the matrix they are drawn with
+class GlyphBatches:
+    def __init__(self, atlas=glyph_atlas):
+        self.atlas = atlas
+        self.table = None
+
+        self.sets = OrderedDict()
+        # key : value
+        # (first layout, layouts left out) :
+        #     (atlas generation, list of (color role, batch))
+        # least recently drawn first
+
+        # Sets of batches made
+        self.built = 0
+
+    # Batches of layouts [first, first + BATCH_LINES) of table,
+    # without the spans of the layouts in excluded
+    def get(self, shader, table, metrics, first, excluded=()):
+        if table is not self.table:
+            self.table = table
+            self.sets.clear()
+
+        key = (first, excluded)
+        entry = self.sets.get(key)
+        if entry is not None and entry[0] == self.atlas.generation:
+            self.sets.move_to_end(key)
+            return entry[1]
+
+        generation = self.atlas.generation
+        batches = self.build(shader, table, metrics, first, excluded)
+        if self.atlas.generation != generation:
+            # The atlas started over while these glyphs were added
+            generation = self.atlas.generation
+            batches = self.build(shader, table, metrics, first, excluded)
+
+        self.sets[key] = (generation, batches)
+        if len(self.sets) > MAX_BATCH_SETS:
+            self.sets.popitem(last=False)
+        self.built += 1
+        return batches
+
+    def build(self, shader, table, metrics, first, excluded):
+        start, stop = np.searchsorted(
+            table.line,
+            (first, first + BATCH_LINES)
+        ).tolist()
+        size = self.atlas.size
+
+        quads = {}
+        # key : value
+        # color role : (vertex positions, texture coordinates)
+
+        rows = zip(
+            table.x[start:stop].tolist(),
+            table.y[start:stop].tolist(),
+            table.size[start:stop].tolist(),
+            table.font[start:stop].tolist(),
+            table.color[start:stop].tolist(),
+            table.start[start:stop].tolist(),
+            table.end[start:stop].tolist(),
+            table.line[start:stop].tolist()
+        )
+        for x, y, font_size, font, color, text_start, text_end, line in rows:
+            if line in excluded:
+                continue
+            role = FONT_ROLES[font]
+            font_path = metrics.font_paths[role]
+            text = table.text[text_start:text_end]
+            offsets = metrics.offsets(text, role, font_size)
+            # Baselines and pens are on whole pixels, like blf's
+            baseline = round(y)
+            if color not in quads:
+                quads[color] = ([], [])
+            positions, coords = quads[color]
+            for char, offset in zip(text, offsets):
+                glyph = self.atlas.glyph(font_path, font_size, char)
+                if glyph is None:
+                    continue
+                left = round(x + offset) + glyph.left
+                right = left + glyph.width
+                top = -(baseline + glyph.top)
+                bottom = top - glyph.height
+
+                u0 = glyph.u / size
+                u1 = (glyph.u + glyph.width) / size
+                v0 = glyph.v / size
+                v1 = (glyph.v + glyph.height) / size
+
+                positions += (
+                    (left, bottom),  # Bottom Left
+                    (right, bottom),  # Bottom Right
+                    (left, top),  # Top Left
+                    (left, top),  # Top Left
+                    (right, bottom),  # Bottom Right
+                    (right, top)  # Top Right
+                )
+                coords += (
+                    (u0, v0),
+                    (u1, v0),
+                    (u0, v1),
+                    (u0, v1),
+                    (u1, v0),
+                    (u1, v1)
+                )
+
+        batches = []
+        for color, (positions, coords) in sorted(quads.items()):
+            if not positions:
+                continue
+            batches.append((color, batch_for_shader(
+                shader,
+                'TRIS',
+                {"pos": positions, "texCoord": coords}
+            )))
+        return batches
+
+    def clear(self):
+        self.table = None
+        self.sets.clear()
+        self.built = 0
+
+
+# Batches of the text of the display list, and of the lines
+# of it highlighted by the search
+text_glyphs = GlyphBatches()
+highlight_glyphs = GlyphBatches()
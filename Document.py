@@ -0,0 +1,731 @@
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from . Layout import DisplayList
+from . Layout import code_after, layout_line, stack_layouts
+from . Layout import estimate_height, hidden_layout, top_margin
+from . Outline import Outline, in_ranges
+from . Search import SearchIndex
+
+
+# Layouts of the lines from first on, lines inside a folded
+# section of outline get an empty stand-in instead
+def layout_lines(
+        style,
+        text_lines,
+        outline,
+        first=0,
+        after_code=False,
+        wrap_width=None):
+    layouts = []
+    for index, line in enumerate(text_lines, first):
+        if outline.is_hidden(index):
+            layouts.append(hidden_layout(line, after_code))
+        else:
+            layouts.append(layout_line(style, line, after_code, wrap_width))
+        after_code = code_after(line, after_code)
+    return layouts
+
+
+# Lines whose folding differs between two sets of hidden ranges
+# Old ranges are in line numbers from before a change of shift
+# lines, only lines from first on are compared
+def refolded(old_hidden, outline, first, shift=0):
+    lines = set()
+    for start, stop in old_hidden:
+        lines.update(range(max(start + shift, first), stop + shift))
+    for start, stop in outline.hidden:
+        lines.update(range(max(start, first), stop))
+    return [
+        line for line in sorted(lines)
+        if in_ranges(old_hidden, line - shift) != outline.is_hidden(line)
+    ]
+
+
+# A laid out document that can be updated line by line
+# It never touches bpy, the caller hands it the current lines
+# and it works out which of them changed
+class Document:
+    def __init__(self, style, viewport):
+        self.style = style
+        self.viewport = tuple(viewport)
+
+        self.source = []
+        # the markdown lines the layouts were made from
+
+        self.layouts = []
+        # LineLayout of every line in source
+
+        self.tops = []
+        # y offset of the top of every layout
+
+        self.display = None
+
+        # How many lines the last update had to lay out
+        self.laid_out = 0
+
+        # Bumped whenever the lines change, layouts made in the
+        # background for an older generation are refused
+        self.generation = 0
+
+        # SearchIndex of source, made for the first search and
+        # kept up to date by update, None until then
+        self.index = None
+
+        # Headings of source, and which sections are folded
+        self.outline = Outline()
+
+    # Lay out every line from scratch, e.g. after the style changed
+    def relayout(self, text_lines, style=None, viewport=None):
+        if style is not None:
+            self.style = style
+        if viewport is not None:
+            self.viewport = tuple(viewport)
+        self.generation += 1
+        source = list(text_lines)
+        if source != self.source:
+            self.index = None
+        self.source = source
+        self.outline.rebuild(self.source)
+        self.layouts = layout_lines(
+            self.style,
+            self.source,
+            self.outline,
+            wrap_width=self.viewport[0]
+        )
+        self.laid_out = len(self.layouts)
+        self.tops, height, width = stack_layouts(
+            self.layouts,
+            self.style.base_size
+        )
+        self.publish(height, width)
+        return self.display
+
+    # Bring the layout up to date with a new version of the text
+    # Only lines that differ from the previous version are laid out,
+    # the layouts below them are kept and moved by the change in height
+    def update(self, text_lines):
+        new = list(text_lines)
+        old = self.source
+        if self.display is None or not self.complete():
+            return self.relayout(new)
+        if new == old:
+            self.laid_out = 0
+            return self.display
+
+        # Common lines at the start and end of both versions
+        limit = min(len(old), len(new))
+        prefix = 0
+        while prefix < limit and old[prefix] == new[prefix]:
+            prefix += 1
+        suffix = 0
+        limit -= prefix
+        while suffix < limit and old[-1 - suffix] == new[-1 - suffix]:
+            suffix += 1
+
+        old_end = len(old) - suffix
+        new_end = len(new) - suffix
+
+        # Headings in the changed lines can move where folded
+        # sections end, hiding or showing lines below them
+        old_hidden = self.outline.hidden
+        self.outline.replace(prefix, old_end, new[prefix:new_end], len(new))
+
+        after_code = False
+        if prefix:
+            above = self.layouts[prefix - 1]
+            after_code = code_after(new[prefix - 1], above.after_code)
+        changed = layout_lines(
+            self.style,
+            new[prefix:new_end],
+            self.outline,
+            prefix,
+            after_code,
+            self.viewport[0]
+        )
+
+        # A line only depends on the code context the line above it
+        # left, so the unchanged lines below are reused as soon as
+        # that matches; opening or closing a fence reaches further
+        for line in new[prefix:new_end]:
+            after_code = code_after(line, after_code)
+        kept = self.layouts[old_end:]
+        for i, layout in enumerate(kept):
+            if layout.after_code == after_code:
+                break
+            changed += layout_lines(
+                self.style,
+                (layout.source,),
+                self.outline,
+                new_end + i,
+                after_code,
+                self.viewport[0]
+            )
+            after_code = code_after(layout.source, after_code)
+            kept[i] = None
+        kept = [layout for layout in kept if layout is not None]
+
+        # Tops of the new layouts, then everything below shifted
+        if prefix < len(self.tops):
+            offset_y = self.tops[prefix]
+        elif self.layouts:
+            offset_y = self.tops[-1] + self.layouts[-1].height
+        else:
+            offset_y = stack_layouts((), self.style.base_size)[1]
+        changed_tops = []
+        for layout in changed:
+            changed_tops.append(offset_y)
+            offset_y += layout.height
+
+        first_kept = len(self.layouts) - len(kept)
+        if kept:
+            shift = offset_y - self.tops[first_kept]
+            kept_tops = [top + shift for top in self.tops[first_kept:]]
+            height = kept_tops[-1] + kept[-1].height
+        else:
+            kept_tops = []
+            height = offset_y
+
+        self.generation += 1
+        self.source = new
+        if self.index is not None:
+            self.index.replace(
+                prefix,
+                old_end,
+                old[prefix:old_end],
+                new[prefix:new_end]
+            )
+        self.layouts = self.layouts[:prefix] + changed + kept
+        self.tops = self.tops[:prefix] + changed_tops + kept_tops
+        self.laid_out = len(changed)
+
+        shift = new_end - old_end
+        if (old_hidden or self.outline.hidden) and self.refold(
+                refolded(old_hidden, self.outline, new_end, shift)):
+            self.tops, height, width = stack_layouts(
+                self.layouts,
+                self.style.base_size
+            )
+        else:
+            width = max((layout.width for layout in self.layouts), default=0)
+        self.publish(height, width)
+        return self.display
+
+    # Lay out again lines that were folded or unfolded
+    # Returns how many were, tops are left for the caller to stack
+    def refold(self, lines):
+        count = 0
+        for index in lines:
+            if index >= len(self.layouts):
+                break
+            layout = self.layouts[index]
+            self.layouts[index] = layout_lines(
+                self.style,
+                (layout.source,),
+                self.outline,
+                index,
+                layout.after_code,
+                self.viewport[0]
+            )[0]
+            count += 1
+        self.laid_out += count
+        return count
+
+    # Fold, or unfold, the section under heading i of the outline
+    # Only the lines of the section are laid out, or emptied
+    def toggle_section(self, i):
+        count = len(self.source)
+        first, stop = self.outline.section(i, count)
+        old_hidden = self.outline.hidden
+        self.outline.toggle(i, count)
+        lines = [
+            line for line in range(first + 1, stop)
+            if in_ranges(old_hidden, line) != self.outline.is_hidden(line)
+        ]
+        self.laid_out = 0
+        if self.refold(lines):
+            self.tops, height, width = stack_layouts(
+                self.layouts,
+                self.style.base_size
+            )
+            self.publish(height, width)
+        return self.display
+
+    # Start over with no line laid out, the layouts are then
+    # appended in order with extend, e.g. by a background job
+    # The display list shown so far stays until the first of them
+    # comes in, so the view doesn't go blank in between
+    # The search index is kept if the lines are the same
+    # Returns the generation extend has to be called with
+    def begin(self, text_lines, style=None, viewport=None):
+        if style is not None:
+            self.style = style
+        if viewport is not None:
+            self.viewport = tuple(viewport)
+        self.generation += 1
+        source = list(text_lines)
+        if source != self.source:
+            self.index = None
+        self.source = source
+        self.outline.rebuild(self.source)
+        self.layouts = []
+        self.tops = []
+        self.laid_out = 0
+        if self.display is None:
+            self.publish(top_margin(self.style.base_size), 0)
+        return self.generation
+
+    # Append the layouts of the next lines
+    # Returns False, adding nothing, if the lines changed since begin
+    def extend(self, layouts, generation):
+        if generation != self.generation:
+            return False
+
+        width = self.viewport[0]
+        if self.layouts:
+            offset_y = self.tops[-1] + self.layouts[-1].height
+        else:
+            offset_y = top_margin(self.style.base_size)
+        for layout in layouts:
+            # The area may have been resized since it was laid out
+            low, high = layout.wrap
+            if self.outline.is_hidden(len(self.layouts)):
+                layout = hidden_layout(layout.source, layout.after_code)
+            elif not low <= width < high:
+                layout = layout_line(
+                    self.style,
+                    layout.source,
+                    layout.after_code,
+                    width
+                )
+            self.layouts.append(layout)
+            self.tops.append(offset_y)
+            offset_y += layout.height
+        self.laid_out = len(self.layouts)
+
+        self.publish(offset_y, max(
+            (layout.width for layout in self.layouts),
+            default=0
+        ))
+        return True
+
+    # Take a SearchIndex built in the background from the lines
+    # of generation
+    # Returns False, keeping none, if the lines changed since
+    def adopt_index(self, index, generation):
+        if generation != self.generation:
+            return False
+        self.index = index
+        return True
+
+    # Show a display list saved by an earlier session for the same
+    # text and style, then wrap it to viewport like after a resize
+    def restore(self, display, outline, viewport):
+        self.generation += 1
+        self.viewport = tuple(display.viewport)
+        self.source = [layout.source for layout in display.layouts]
+        self.index = None
+        self.outline = outline
+        self.layouts = list(display.layouts)
+        self.tops = list(display.tops)
+        self.laid_out = 0
+        self.display = display
+        return self.rewrap(viewport)
+
+    # False while lines are still waiting to be laid out
+    def complete(self):
+        return len(self.layouts) == len(self.source)
+
+    # Wrap to a new viewport width
+    # Only the lines whose breaks don't hold for the new width
+    # are laid out again, the rest keep their layout
+    def rewrap(self, viewport):
+        viewport = tuple(viewport)
+        width = viewport[0]
+        previous = self.viewport[0]
+        self.viewport = viewport
+        if self.display is None or width == previous:
+            return self.display
+
+        self.laid_out = 0
+        for i, layout in enumerate(self.layouts):
+            low, high = layout.wrap
+            if low <= width < high:
+                continue
+            self.layouts[i] = layout_line(
+                self.style,
+                layout.source,
+                layout.after_code,
+                width
+            )
+            self.laid_out += 1
+
+        if self.laid_out:
+            self.tops, height, width = stack_layouts(
+                self.layouts,
+                self.style.base_size
+            )
+            self.publish(height, width)
+        return self.display
+
+    # Lay out again every line showing one of the given images,
+    # e.g. after their files changed on disk
+    def reload_images(self, keys):
+        self.laid_out = 0
+        for i, layout in enumerate(self.layouts):
+            if not any(image.key in keys for image in layout.images):
+                continue
+            self.layouts[i] = layout_line(
+                self.style,
+                layout.source,
+                layout.after_code,
+                self.viewport[0]
+            )
+            self.laid_out += 1
+
+        if self.laid_out:
+            self.tops, height, width = stack_layouts(
+                self.layouts,
+                self.style.base_size
+            )
+            self.publish(height, width)
+        return self.display
+
+    # Ascending numbers of the lines matching a query,
+    # None while the lines aren't indexed yet
+    def search(self, query):
+        if self.index is None:
+            return None
+        return self.index.search(query)
+
+    # y offset of the top of a line
+    def line_top(self, index):
+        if index < len(self.tops):
+            return self.tops[index]
+        return self.display.height
+
+    # Number of the line at y
+    def line_at(self, y):
+        return max(0, bisect_right(self.tops, y) - 1)
+
+    # The whole document is always laid out
+    def view(self, top, bottom):
+        return self.display
+
+    def publish(self, height, width):
+        self.display = DisplayList(
+            tuple(self.layouts),
+            tuple(self.tops),
+            width,
+            height,
+            self.viewport,
+            self.style.base_size,
+            0
+        )
+
+
+# Heights of every line of a very long document
+# Lines start out at an estimated height; a Fenwick tree of the
+# differences from the estimate gives the top of any line, and the
+# line at any y, in O(log n) as real heights come in
+class HeightIndex:
+    def __init__(self, count, estimate):
+        self.count = count
+        self.estimate = estimate
+        self.deltas = array('d', bytes(8 * count))
+        self.tree = array('d', bytes(8 * (count + 1)))
+
+    def set(self, index, height):
+        change = height - self.estimate - self.deltas[index]
+        if not change:
+            return
+        self.deltas[index] += change
+        index += 1
+        while index <= self.count:
+            self.tree[index] += change
+            index += index & -index
+
+    # Take the deltas of another HeightIndex over the same lines
+    # The tree is built in one pass: every node adds itself to its parent
+    def load(self, deltas):
+        self.deltas = array('d', deltas)
+        tree = array('d', bytes(8))
+        tree += self.deltas
+        for index in range(1, self.count + 1):
+            parent = index + (index & -index)
+            if parent <= self.count:
+                tree[parent] += tree[index]
+        self.tree = tree
+
+    # Total height of lines [0, index)
+    def prefix(self, index):
+        total = index * self.estimate
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def total(self):
+        return self.prefix(self.count)
+
+    # Index of the line containing y, measured from the first line
+    def find(self, y):
+        position = 0
+        covered = 0.0
+        step = 1 << self.count.bit_length()
+        while step:
+            following = position + step
+            if following <= self.count:
+                height = covered + self.tree[following] + step * self.estimate
+                if height <= y:
+                    position = following
+                    covered = height
+            step >>= 1
+        return min(position, max(self.count - 1, 0))
+
+
+# A very long document that is only laid out around the view
+# Lines are laid out in chunks as they come near the area, the rest
+# count with an estimated height until then. The display list only
+# holds the laid out window, so it stays small whatever the file size.
+class VirtualDocument:
+    def __init__(self, style, viewport, chunk=256, max_chunks=64):
+        self.style = style
+        self.viewport = tuple(viewport)
+        self.chunk = chunk
+        self.max_chunks = max_chunks
+
+        self.source = []
+        # any sequence of lines, read only when laid out
+
+        self.chunks = OrderedDict()
+        # key : value
+        # first line index of the chunk : list of LineLayout
+        # least recently viewed first
+
+        self.heights = None
+        self.window = (0, 0)
+        self.display = None
+        self.laid_out = 0
+        self.generation = 0
+        self.index = None
+        self.outline = Outline()
+
+    def relayout(self, text_lines, style=None, viewport=None):
+        if style is not None:
+            self.style = style
+        if viewport is not None:
+            self.viewport = tuple(viewport)
+        if text_lines is not self.source:
+            self.index = None
+        self.source = text_lines
+        self.generation += 1
+        self.chunks.clear()
+        self.heights = HeightIndex(
+            len(text_lines),
+            estimate_height(self.style.base_size)
+        )
+        self.outline.rebuild(text_lines)
+        for start, stop in self.outline.hidden:
+            for index in range(start, stop):
+                self.heights.set(index, 0)
+        self.window = (0, 0)
+        self.laid_out = 0
+        # First paint only needs the top of the document
+        return self.view(0, self.viewport[1])
+
+    # Show chunks and line heights saved by an earlier session for
+    # the same text and style, then wrap them to viewport
+    def restore(self, text_lines, chunks, deltas, outline, saved, viewport):
+        self.viewport = tuple(saved)
+        self.source = text_lines
+        self.generation += 1
+        self.index = None
+        self.chunks = OrderedDict(
+            (first, list(layouts)) for first, layouts in chunks
+        )
+        self.heights = HeightIndex(
+            len(text_lines),
+            estimate_height(self.style.base_size)
+        )
+        self.heights.load(deltas)
+        self.outline = outline
+        self.window = (0, 0)
+        self.publish(0, 0)
+        self.rewrap(viewport)
+        return self.view(0, self.viewport[1])
+
+    # The whole file is indexed on the worker by the first search,
+    # see Format.index_text
+    def search(self, query):
+        if self.index is None:
+            return None
+        return self.index.search(query)
+
+    def adopt_index(self, index, generation):
+        if generation != self.generation:
+            return False
+        self.index = index
+        return True
+
+    def line_top(self, index):
+        margin = top_margin(self.style.base_size)
+        return margin + self.heights.prefix(min(index, len(self.source)))
+
+    def line_at(self, y):
+        margin = top_margin(self.style.base_size)
+        return self.heights.find(y - margin)
+
+    # Lines are laid out on demand, there is never anything waiting
+    def complete(self):
+        return True
+
+    # Virtual documents are read only, any change starts over
+    def update(self, text_lines):
+        return self.relayout(text_lines)
+
+    # Wrap the laid out chunks to a new viewport width, lines further
+    # away are wrapped when they are laid out
+    def rewrap(self, viewport):
+        viewport = tuple(viewport)
+        width = viewport[0]
+        previous = self.viewport[0]
+        self.viewport = viewport
+        if self.display is None or width == previous:
+            return self.display
+
+        self.laid_out = 0
+        for first, layouts in self.chunks.items():
+            for i, layout in enumerate(layouts):
+                low, high = layout.wrap
+                if low <= width < high:
+                    continue
+                layout = layout_line(
+                    self.style,
+                    layout.source,
+                    layout.after_code,
+                    width
+                )
+                layouts[i] = layout
+                self.heights.set(first + i, layout.height)
+                self.laid_out += 1
+
+        if self.laid_out:
+            # The next view publishes the window again
+            self.window = (0, 0)
+        return self.display
+
+    def reload_images(self, keys):
+        self.laid_out = 0
+        for first, layouts in self.chunks.items():
+            for i, layout in enumerate(layouts):
+                if not any(image.key in keys for image in layout.images):
+                    continue
+                layout = layout_line(
+                    self.style,
+                    layout.source,
+                    layout.after_code,
+                    self.viewport[0]
+                )
+                layouts[i] = layout
+                self.heights.set(first + i, layout.height)
+                self.laid_out += 1
+
+        if self.laid_out:
+            self.window = (0, 0)
+        return self.display
+
+    def layout_chunk(self, first):
+        layouts = self.chunks.get(first)
+        if layouts is not None:
+            self.chunks.move_to_end(first)
+            return layouts
+
+        stop = min(first + self.chunk, len(self.source))
+        layouts = layout_lines(
+            self.style,
+            self.source[first:stop],
+            self.outline,
+            first,
+            self.outline.code_context(self.source, first),
+            self.viewport[0]
+        )
+        for index, layout in enumerate(layouts, first):
+            self.heights.set(index, layout.height)
+        self.laid_out += len(layouts)
+
+        self.chunks[first] = layouts
+        if len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)
+        return layouts
+
+    # Fold, or unfold, the section under heading i of the outline
+    # Lines of the section count with no height, or the estimate,
+    # until their chunk is laid out again by the next view
+    def toggle_section(self, i):
+        count = len(self.source)
+        first, stop = self.outline.section(i, count)
+        old_hidden = self.outline.hidden
+        self.outline.toggle(i, count)
+        estimate = estimate_height(self.style.base_size)
+        for line in range(first + 1, stop):
+            hidden = self.outline.is_hidden(line)
+            if in_ranges(old_hidden, line) != hidden:
+                self.heights.set(line, 0 if hidden else estimate)
+        for chunk_start in list(self.chunks):
+            if chunk_start < stop and first < chunk_start + self.chunk:
+                del self.chunks[chunk_start]
+        self.window = (0, 0)
+        return self.display
+
+    # Display list covering top <= y <= bottom, laying out whatever
+    # part of it hasn't been yet. A screen either side is laid out
+    # ahead, so scrolling within it keeps the same display list.
+    def view(self, top, bottom):
+        count = len(self.source)
+        if not count:
+            self.publish(0, 0)
+            return self.display
+
+        margin = top_margin(self.style.base_size)
+        first = self.heights.find(top - margin)
+        last = self.heights.find(bottom - margin) + 1
+
+        start, stop = self.window
+        if self.display is not None and start <= first and last <= stop:
+            return self.display
+
+        pad = last - first
+        start = max(0, first - pad) // self.chunk * self.chunk
+        stop = min(count, last + pad)
+
+        self.laid_out = 0
+        layouts = []
+        for chunk_start in range(start, stop, self.chunk):
+            layouts += self.layout_chunk(chunk_start)
+        stop = start + len(layouts)
+
+        self.window = (start, stop)
+        self.publish(start, stop, layouts)
+        return self.display
+
+    def publish(self, start, stop, layouts=()):
+        offset_y = top_margin(self.style.base_size)
+        tops = []
+        top = offset_y + self.heights.prefix(start) if start < stop else 0
+        for layout in layouts:
+            tops.append(top)
+            top += layout.height
+        width = max((layout.width for layout in layouts), default=0)
+        height = offset_y
+        if self.heights is not None:
+            height += self.heights.total()
+        self.display = DisplayList(
+            tuple(layouts),
+            tuple(tops),
+            width,
+            height,
+            self.viewport,
+            self.style.base_size,
+            start
+        )
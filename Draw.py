@@ -1,44 +1,134 @@
 import blf
 import gpu
+import numpy as np
 from gpu_extras.batch import batch_for_shader
+from . Layout import visible_range, visible_spans, pack_spans
+from . Layout import FONT_ROLES
+from . Layout import BACKGROUND, BLOCK
+from . Search import search_state
+from . Atlas import text_glyphs, highlight_glyphs
+from . Atlas import BATCH_LINES
+
+
+# Function to find the part of the document the area is showing,
+# as (top, bottom) y offsets measured from the top of the document
+def get_view(context, margin=0, scale=1):
+    x = context.region.x
+    y = context.region.y
+    view = context.region.view2d
+    scroll = view.region_to_view(x, y)
+    scroll_factor = 5
+
+    scroll_y = 0
+    if scroll[1] < 0:
+        scroll_y = scroll[1] / scroll_factor
+
+    top = -scroll_y - margin
+    bottom = -scroll_y + context.area.height + margin
+    return top / scale, bottom / scale
+
+
+# Function to get how much the layout is stretched by
+# While the Size slider is dragged the last layout is scaled
+# to preview the new size, until it is laid out again
+def get_scale(context, document):
+    base_size = context.scene.docview_props.base_size
+    return base_size / document.style.base_size
+
+
+# Function to get the display list for the current view
+# Streamed documents lay out the part around the view on demand
+# Areas can be resized without an event reaching the viewer, e.g. by
+# dragging the edge of a neighbour, so the wrap width is checked here
+def get_display(context, document, scale=1):
+    if document.viewport[0] != context.area.width:
+        document.rewrap((context.area.width, context.area.height))
+    return document.view(*get_view(context, scale=scale))
+
+
+# Function to find the line layouts of the display list that are on screen
+# The tops of the layouts are bisected with the current scroll,
+# so the cost depends on the size of the area, not of the document
+# Yields (top, layout) pairs
+def get_visible(context, display, margin=0, scale=1):
+    top, bottom = get_view(context, margin, scale)
+    first, last = visible_range(display.tops, top, bottom)
+    return zip(display.tops[first:last], display.layouts[first:last])
+
+
+# Builtin shaders are compiled once and shared by every handler
+shaders = {}
+# key : value
+# builtin shader name : gpu shader
+
+
+def get_shader(name):
+    if name not in shaders:
+        shaders[name] = gpu.shader.from_builtin(name)
+    return shaders[name]
+
+
+# Batches are only rebuilt when what they were built from changes
+batches = {}
+# key : value
+# batch name : (source, batch)
+# 'bg' : ((width, height), batch)
+# 'spans' : (display list, SpanTable)
+# 'highlight' : ((display list, query, first, last), SpanTable)
+
+
+def get_batch(name, source, build):
+    cached = batches.get(name)
+    if cached is not None and cached[0] is source:
+        return cached[1]
+    if cached is not None and cached[0] == source:
+        batch = cached[1]
+    else:
+        batch = build()
+    batches[name] = (source, batch)
+    return batch
+
+
+# Two triangles per rectangle, for quads listed as
+# Bottom Left, Bottom Right, Top Left, Top Right
+def quad_indices(count):
+    indices = []
+    for quad in range(count):
+        i = quad * 4
+        indices.append((i, i + 1, i + 2))  # _ \
+        indices.append((i + 2, i + 1, i + 3))  # \ |
+    return indices
 
 
 # Function to set up Background drawing
 def draw_bg(self, context):
     if context.area.ui_type == 'DocumentViewer':
         props = context.scene.docview_props
-        current_theme = props.current_theme
-        themes = props.themes
-        theme = themes[current_theme]
-        bg_color = theme[:4]
+        bg_color = props.palette()[BACKGROUND]
 
         width = context.area.width
         height = context.area.height
 
-    # Here we define the positions of the vertices of the background
-        bg_vertices = (
-            (0, 0),  # Bottom Left
-            (width, 0),  # Bottom Right
-            (0, height),  # Top Left
-            (width, height)  # Top Right
-        )
+        bg_shader = get_shader('UNIFORM_COLOR')
 
-    # This defines the order in which we connect the vertices,
-    # creating two triangles
-        indices = (
-            (0, 1, 2),  # _ \
-            (2, 1, 3)  # \ |
-        )
+        def build():
+            # Here we define the positions of the vertices of the background
+            bg_vertices = (
+                (0, 0),  # Bottom Left
+                (width, 0),  # Bottom Right
+                (0, height),  # Top Left
+                (width, height)  # Top Right
+            )
+            return batch_for_shader(
+                bg_shader,
+                'TRIS',
+                {"pos": bg_vertices},
+                indices=quad_indices(1)
+            )
 
-    # Creating the shader to fill in the faces we created above
-        bg_shader = gpu.shader.from_builtin('UNIFORM_COLOR')
-        batch = batch_for_shader(
-            bg_shader,
-            'TRIS',
-            {"pos": bg_vertices},
-            indices=indices
-        )
-    # This is where we define the background color
+        batch = get_batch('bg', (width, height), build)
+
+        # This is where we define the background color
         bg_shader.uniform_float(
             "color",
             bg_color
@@ -46,16 +136,74 @@ def draw_bg(self, context):
         batch.draw(bg_shader)
 
 
+# Every code and quote rectangle of a layout in a single vertex buffer
+# Vertices are relative to the top of the document, going down,
+# so scrolling and resizing the area only change the model-view offset
+def build_block_batch(shader, display):
+    base_size = display.base_size
+    quarter = base_size / 4
+    three_quarters = base_size - quarter
+
+    code_blocks = []
+    quote_blocks = []
+    for top, layout in zip(display.tops, display.layouts):
+        for block in layout.code_blocks:
+            code_blocks.append((top + block.y, block))
+        for block in layout.quote_blocks:
+            quote_blocks.append((top + block.y, block))
+
+    length = 0
+    for offset_y, block in code_blocks:
+        if block.length > length:
+            length = block.length
+    length = length * base_size * 0.7
+
+    vertices = []
+
+    for offset_y, block in code_blocks:
+        left = block.x
+        center = base_size / 8 - offset_y
+        bottom = center - three_quarters
+        top = center + three_quarters
+        vertices += [
+            (left, bottom),  # Bottom Left
+            (length, bottom),  # Bottom Right
+            (left, top),  # Top Left
+            (length, top)  # Top Right
+        ]
+
+    for offset_y, block in quote_blocks:
+        left = block.x
+        right = left + (base_size / 2)
+        center = base_size / 4 - offset_y
+        bottom = center - three_quarters
+        top = center + three_quarters
+        vertices += [
+            (left, bottom),  # Bottom Left
+            (right, bottom),  # Bottom Right
+            (left, top),  # Top Left
+            (right, top)  # Top Right
+        ]
+
+    if not vertices:
+        return None
+
+    return batch_for_shader(
+        shader,
+        'TRIS',
+        {"pos": vertices},
+        indices=quad_indices(len(vertices) // 4)
+    )
+
+
 # Function to set up Code and Quote block drawing
-def draw_block(self, context, code_blocks, quote_blocks):
+def draw_block(self, context, document):
     if context.area.ui_type == 'DocumentViewer':
+        scale = get_scale(context, document)
+        display = get_display(context, document, scale)
         props = context.scene.docview_props
-        base_size = props.base_size
 
-        current_theme = props.current_theme
-        themes = props.themes
-        theme = themes[current_theme]
-        block_color = theme[4:8]
+        block_color = props.palette()[BLOCK]
 
         x = context.region.x
         y = context.region.y
@@ -63,224 +211,327 @@ def draw_block(self, context, code_blocks, quote_blocks):
         scroll = view.region_to_view(x, y)
         scroll_factor = 5
 
-        #  width = context.area.width
-        height = context.area.height
+        offset_x = 0
+        offset_y = context.area.height
+        if scroll[0] > 0:
+            offset_x -= scroll[0] / scroll_factor
+        if scroll[1] < 0:
+            offset_y -= scroll[1] / scroll_factor
 
-        length = 0
-        for block in code_blocks:
-            if code_blocks[block][2] > length:
-                length = code_blocks[block][2]
-        length = length * base_size * 0.7
+        shader = get_shader('UNIFORM_COLOR')
+        batch = get_batch(
+            'block',
+            display,
+            lambda: build_block_batch(shader, display)
+        )
+        if batch is None:
+            return
 
-        for block in code_blocks:
-            offset_x = code_blocks[block][0]
-            offset_y = height - code_blocks[block][1] + base_size / 8
+        shader.uniform_float(
+            "color",
+            block_color
+        )
+        with gpu.matrix.push_pop():
+            gpu.matrix.translate((offset_x, offset_y))
+            gpu.matrix.scale((scale, scale))
+            batch.draw(shader)
 
-            if scroll[0] > 0:
-                offset_x -= scroll[0] / scroll_factor
-            if scroll[1] < 0:
-                offset_y -= scroll[1] / scroll_factor
-
-            quarter = base_size / 4
-            three_quarters = base_size - quarter
-            bottom = offset_y - three_quarters
-            top = offset_y + three_quarters
-
-            # Here we define the positions of the vertices of the blocks
-            code_block_vertices = (
-                (offset_x, bottom),  # Bottom Left
-                (length, bottom),  # Bottom Right
-                (offset_x, top),  # Top Left
-                (length, top)  # Top Right
-            )
 
-            # This defines the order in which we connect the vertices,
-            # creating two triangles
-            indices = (
-                (0, 1, 2),  # _ \
-                (2, 1, 3)  # \ |
-            )
+# Function to set up Image drawing
+# Images load in the background: a placeholder in the block color is
+# drawn until the texture is ready, and images far outside the area
+# give their texture back until they are scrolled near again
+def draw_image(self, context, document, images):
+    if context.area.ui_type == 'DocumentViewer':
+        scale = get_scale(context, document)
+        display = get_display(context, document, scale)
+        props = context.scene.docview_props
+        block_color = props.palette()[BLOCK]
 
-            # Creating the shader to fill in the faces we created above
-            code_block_shader = gpu.shader.from_builtin('UNIFORM_COLOR')
-            batch = batch_for_shader(
-                code_block_shader,
-                'TRIS',
-                {"pos": code_block_vertices},
-                indices=indices
-            )
-            # This is where we define the background color
-            code_block_shader.uniform_float(
-                "color",
-                block_color
-            )
-            batch.draw(code_block_shader)
+        x = context.region.x
+        y = context.region.y
+        view = context.region.view2d
+        scroll = view.region_to_view(x, y)
+        scroll_factor = 5
+        area_height = context.area.height
+
+        visible = [
+            (top, image)
+            for top, layout in get_visible(context, display, scale=scale)
+            for image in layout.images
+        ]
+        images.show(
+            context.area.as_pointer(),
+            [image.key for top, image in visible]
+        )
 
-        for block in quote_blocks:
-            offset_x = quote_blocks[block][0]
-            offset_y = height - quote_blocks[block][1] + base_size / 4
+        # Everything within a screen of the area stays resident
+        nearby = get_visible(context, display, area_height, scale)
+        nearby = {
+            image.key
+            for top, layout in nearby
+            for image in layout.images
+        }
+        for key in images.resident():
+            if key not in nearby:
+                images.release(key)
+
+        for top, image in visible:
+            width = image.width * scale
+            height = image.height * scale
+            image_x = image.x * scale
+            image_y = area_height - height - (top + image.y) * scale
 
             if scroll[0] > 0:
-                offset_x -= scroll[0] / scroll_factor
+                image_x -= scroll[0] / scroll_factor
             if scroll[1] < 0:
-                offset_y -= scroll[1] / scroll_factor
-
-            quarter = base_size / 4
-            three_quarters = base_size - quarter
-            bottom = offset_y - three_quarters
-            top = offset_y + three_quarters
-            width = offset_x + (base_size / 2)
-            # Here we define the positions of the vertices of the blocks
-            quote_block_vertices = (
-                (offset_x, bottom),  # Bottom Left
-                (width, bottom),  # Bottom Right
-                (offset_x, top),  # Top Left
-                (width, top)  # Top Right
-            )
+                image_y -= scroll[1] / scroll_factor
 
-            # This defines the order in which we connect the vertices,
-            # creating two triangles
-            indices = (
-                (0, 1, 2),  # _ \
-                (2, 1, 3)  # \ |
+            vertices = (
+                (image_x, image_y),
+                (image_x + width, image_y),
+                (image_x + width, image_y + height),
+                (image_x, image_y + height)
             )
 
-            # Creating the shader to fill in the faces we created above
-            quote_block_shader = gpu.shader.from_builtin('UNIFORM_COLOR')
-            batch = batch_for_shader(
-                quote_block_shader,
-                'TRIS',
-                {"pos": quote_block_vertices},
-                indices=indices
-            )
-            # This is where we define the background color
-            quote_block_shader.uniform_float(
-                "color",
-                block_color
-            )
-            batch.draw(quote_block_shader)
-
-
-def draw_image(self, context, images):
-    if context.area.ui_type == 'DocumentViewer':
-        x = context.region.x
-        y = context.region.y
-        view = context.region.view2d
-        scroll = view.region_to_view(x, y)
-        scroll_factor = 5
+            texture = images.texture(image.key, width)
+            if texture is None:
+                shader = get_shader('UNIFORM_COLOR')
+                batch = batch_for_shader(
+                    shader, 'TRI_FAN',
+                    {"pos": vertices}
+                )
+                shader.uniform_float("color", block_color)
+                batch.draw(shader)
+                continue
 
-    for image in images:
-        image = images[image][0]
-        texture = images[image][1]
-        width = images[image][2]
-        height = images[image][3]
-        image_x = images[image][4]
-        image_y = images[image][5]
+            try:
+                shader = get_shader('IMAGE_COLOR')
+            except (NameError, ValueError):
+                shader = get_shader('2D_IMAGE')
 
-        if scroll[0] > 0:
-            image_x -= scroll[0] / scroll_factor
-        if scroll[1] < 0:
-            image_y -= scroll[1] / scroll_factor
-
-        try:
-            shader = gpu.shader.from_builtin('IMAGE_COLOR')
-        except NameError:
-            shader = gpu.shader.from_builtin('2D_IMAGE')
-
-        batch = batch_for_shader(
-            shader, 'TRI_FAN',
-            {
-                "pos": (
-                    (image_x, image_y),
-                    (image_x + width, image_y),
-                    (image_x + width, image_y + height),
-                    (image_x, image_y + height)
-                ),
-                "texCoord": (
-                    (0, 0),
-                    (1, 0),
-                    (1, 1),
-                    (0, 1)
-                ),
-            },
+            batch = batch_for_shader(
+                shader, 'TRI_FAN',
+                {
+                    "pos": vertices,
+                    "texCoord": (
+                        (0, 0),
+                        (1, 0),
+                        (1, 1),
+                        (0, 1)
+                    ),
+                },
+            )
+            gpu.state.blend_set("ALPHA")
+            shader.bind()
+            shader.uniform_sampler("image", texture)
+            batch.draw(shader)
+
+
+# Draw the given spans of a SpanTable
+# Culling, scaling and scrolling are done for every span at once
+def draw_spans(context, table, visible, scale, palette, font_ids):
+    if not len(visible):
+        return
+
+    x = context.region.x
+    y = context.region.y
+    view = context.region.view2d
+    scroll = view.region_to_view(x, y)
+    scroll_factor = 5
+
+    offset_x = table.x[visible] * scale
+    offset_y = table.y[visible] * scale
+    if scroll[0] > 0:
+        offset_x -= scroll[0] / scroll_factor
+    if scroll[1] < 0:
+        offset_y += scroll[1] / scroll_factor
+    offset_y = context.area.height - offset_y
+    sizes = table.size[visible] * scale
+
+    # Spans are drawn grouped by font, size and color, so code split
+    # into many colored runs still sets each of them once per group
+    order = np.lexsort((
+        table.color[visible],
+        sizes,
+        table.font[visible]
+    )).tolist()
+    visible = visible.tolist()
+    offset_x = offset_x.tolist()
+    offset_y = offset_y.tolist()
+    sizes = sizes.tolist()
+
+    text = table.text
+    state = None
+    color = None
+    for j in order:
+        i = visible[j]
+        font_id = font_ids[table.font[i]]
+        size = sizes[j]
+        if state != (font_id, size):
+            state = (font_id, size)
+            color = None
+            blf.size(font_id, size)
+        if color != table.color[i]:
+            color = table.color[i]
+            blf.color(font_id, *palette[color])
+        blf.position(font_id, offset_x[j], offset_y[j], 0)
+        blf.draw(font_id, text[table.start[i]:table.end[i]])
+
+
+# Shader the glyph atlas is drawn with, None if this Blender has no
+# image shader taking a color
+def get_glyph_shader():
+    try:
+        return get_shader('IMAGE_COLOR')
+    except (NameError, ValueError):
+        return None
+
+
+# Draw layouts [first, last) of a SpanTable from the glyph atlas,
+# first being a multiple of BATCH_LINES
+# Their glyph batches are made once, scrolling only moves them
+def draw_glyphs(
+        context,
+        shader,
+        glyphs,
+        table,
+        first,
+        last,
+        scale,
+        palette,
+        metrics,
+        excluded=()):
+    if first >= last:
+        return
+
+    x = context.region.x
+    y = context.region.y
+    view = context.region.view2d
+    scroll = view.region_to_view(x, y)
+    scroll_factor = 5
+
+    offset_x = 0
+    offset_y = context.area.height
+    if scroll[0] > 0:
+        offset_x -= scroll[0] / scroll_factor
+    if scroll[1] < 0:
+        offset_y -= scroll[1] / scroll_factor
+
+    sets = []
+    for start in range(first, last, BATCH_LINES):
+        left_out = tuple(
+            line for line in excluded
+            if start <= line < start + BATCH_LINES
         )
-        gpu.state.blend_set("ALPHA")
+        sets.append(glyphs.get(shader, table, metrics, start, left_out))
+    # Uploaded after the batches, which may have added glyphs
+    texture = glyphs.atlas.get_texture()
+
+    gpu.state.blend_set("ALPHA")
+    with gpu.matrix.push_pop():
+        gpu.matrix.translate((offset_x, offset_y))
+        gpu.matrix.scale((scale, scale))
         shader.bind()
         shader.uniform_sampler("image", texture)
-        batch.draw(shader)
+        for batches in sets:
+            for color, batch in batches:
+                shader.uniform_float("color", palette[color])
+                batch.draw(shader)
 
 
 # Function to setup Text drawing
 def draw_text(
         self,
         context,
-        draw_lines,
-        sub_lines,
-        offset_x,
-        offset_y):
+        document,
+        fonts):
     if context.area.ui_type == 'DocumentViewer':
-        x = context.region.x
-        y = context.region.y
-        view = context.region.view2d
-        scroll = view.region_to_view(x, y)
-        scroll_factor = 5
+        # Layout only stores color roles, the theme is applied here
+        props = context.scene.docview_props
+        palette = props.palette()
+        font_ids = [fonts[role] for role in FONT_ROLES]
+        # The glyph atlas needs an image shader taking a color
+        shader = get_glyph_shader() if props.glyph_atlas else None
+        metrics = document.style.metrics
+
+        scale = get_scale(context, document)
+        display = get_display(context, document, scale)
+        table = get_batch('spans', display, lambda: pack_spans(display))
+
+        top, bottom = get_view(context, scale=scale)
+        first, last = visible_range(display.tops, top, bottom)
+        if shader is not None:
+            # Glyphs are batched BATCH_LINES layouts at a time, and so
+            # are the lines left out for the search, so scrolling within
+            # them never makes new batches
+            first -= first % BATCH_LINES
+            last = min(
+                -(-last // BATCH_LINES) * BATCH_LINES,
+                len(display.layouts)
+            )
+
+        # Visible lines matching the search are drawn from a table
+        # of their own, cut where the matching words are highlighted
+        indices = []
+        highlighted = None
+        matches = search_state.find(document)
+        if matches is not None and len(matches):
+            start = first + display.first
+            stop = last + display.first
+            matches = matches[
+                np.searchsorted(matches, start):
+                np.searchsorted(matches, stop)
+            ]
+            indices = (matches - display.first).tolist()
+            highlighted = get_batch(
+                'highlight',
+                (display, search_state.query, start, stop),
+                lambda: pack_spans(
+                    display,
+                    indices,
+                    search_state.pattern,
+                    metrics
+                )
+            )
 
-        lines = draw_lines
-        sub = sub_lines
-
-        for line_text in lines:
-
-            link = lines[line_text][6]
-            image = lines[line_text][7]
-
-            if link and not image:
-                for sub_index in sub:
-                    char = sub[sub_index][0]
-                    font_id = sub[sub_index][1]
-                    text_size = sub[sub_index][2]
-                    char_color = sub[sub_index][3]
-                    offset_x = sub[sub_index][4]
-                    offset_y = sub[sub_index][5]
-
-                    if scroll[0] > 0:
-                        offset_x -= scroll[0] / scroll_factor
-                    if scroll[1] < 0:
-                        offset_y += scroll[1] / scroll_factor
-
-    #                offset_x += context.scene.offset_x
-    #                offset_y += context.scene.offset_y
-
-                    blf.size(font_id, text_size)
-                    blf.position(
-                        font_id,
-                        offset_x,
-                        context.area.height - offset_y,
-                        0
-                    )
-                    blf.color(font_id, *char_color)
-                    blf.draw(font_id, char)
-            else:
-                line = lines[line_text][0]
-                font_id = lines[line_text][1]
-                text_size = lines[line_text][2]
-                line_color = lines[line_text][3]
-                offset_x = lines[line_text][4]
-                offset_y = lines[line_text][5]
-
-                if scroll[0] > 0:
-                    offset_x -= scroll[0] / scroll_factor
-                if scroll[1] < 0:
-                    offset_y += scroll[1] / scroll_factor
-
-    #            offset_x += context.scene.offset_x
-    #            offset_y += context.scene.offset_y
-
-                blf.size(font_id, text_size)
-                blf.position(
-                    font_id,
-                    offset_x,
-                    context.area.height - offset_y,
-                    0
+        if shader is not None:
+            if highlighted is not None:
+                draw_glyphs(
+                    context,
+                    shader,
+                    highlight_glyphs,
+                    highlighted,
+                    first,
+                    last,
+                    scale,
+                    palette,
+                    metrics
                 )
-                blf.color(font_id, *line_color)
-                blf.draw(font_id, line)
+            draw_glyphs(
+                context,
+                shader,
+                text_glyphs,
+                table,
+                first,
+                last,
+                scale,
+                palette,
+                metrics,
+                indices
+            )
+            return
+
+        visible = visible_spans(table, top, bottom)
+        if highlighted is not None:
+            visible = visible[~np.isin(table.line[visible], indices)]
+            draw_spans(
+                context,
+                highlighted,
+                np.arange(len(highlighted.x)),
+                scale,
+                palette,
+                font_ids
+            )
+
+        draw_spans(context, table, visible, scale, palette, font_ids)
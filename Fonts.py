@@ -0,0 +1,86 @@
+import blf
+import os
+import time
+from . Layout import REGULAR, ITALIC, BOLD, CODE, FONT_ROLES
+
+
+# Role whose font is used when a role's own font file is missing
+FALLBACKS = {
+    ITALIC: REGULAR,
+    BOLD: REGULAR,
+    CODE: REGULAR,
+}
+
+# blf's built-in font, drawn with when no font file of a chain exists
+DEFAULT_FONT = 0
+
+
+# Font file actually used for every role, following FALLBACKS
+# until an existing file is found, None if there is none
+# Drawing and measuring both go through this, so they always agree
+def resolve_paths(font_paths):
+    resolved = {}
+    for role in FONT_ROLES:
+        current = role
+        path = None
+        while current is not None:
+            candidate = font_paths.get(current)
+            if candidate and os.path.exists(candidate):
+                path = os.path.abspath(candidate)
+                break
+            current = FALLBACKS.get(current)
+        resolved[role] = path
+    return resolved
+
+
+# Process-wide blf font handles
+# Every font file is loaded once and keeps the same id for every
+# viewer and every Draw Document, until the add-on is unregistered
+class FontRegistry:
+    def __init__(self):
+        self.handles = {}
+        # key : value
+        # absolute font path : blf font id
+
+        # Files loaded, lookups served from handles, files blf
+        # couldn't load and the seconds spent in blf.load
+        self.loads = 0
+        self.hits = 0
+        self.failures = 0
+        self.load_time = 0.0
+
+    def load(self, path):
+        if path is None:
+            return DEFAULT_FONT
+        font_id = self.handles.get(path)
+        if font_id is not None:
+            self.hits += 1
+            return font_id
+
+        start = time.perf_counter()
+        font_id = blf.load(path)
+        self.load_time += time.perf_counter() - start
+        if font_id == -1:
+            self.failures += 1
+            return DEFAULT_FONT
+
+        self.loads += 1
+        self.handles[path] = font_id
+        return font_id
+
+    # blf font id of every role, for the draw handlers
+    def fonts(self, font_paths):
+        resolved = resolve_paths(font_paths)
+        return {role: self.load(resolved[role]) for role in FONT_ROLES}
+
+    def unload(self):
+        for path in self.handles:
+            blf.unload(path)
+        self.handles.clear()
+        self.loads = 0
+        self.hits = 0
+        self.failures = 0
+        self.load_time = 0.0
+
+
+font_registry = FontRegistry()
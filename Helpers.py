@@ -1,16 +1,351 @@
 import bpy
-from PIL import ImageFont
+import numpy as np
+from . Fonts import font_registry
+from . Tabs import document_cache, image_keys
+from . Redraw import redraw
+from . Watch import watcher, file_stamp
+from . Worker import layout_worker
+from . Images import image_cache
+from . Source import open_lines
+from . Store import layout_store
+from . Atlas import glyph_atlas, text_glyphs
+from . Search import search_state
+from . Format import reflow_text, update_text, index_text
 
 
-# Function to calculate screen size of rendered characters
-def get_pil_text_size(text, font_size, font_name):
-    font = ImageFont.truetype(font_name, font_size)
-    size = font.getbbox(text)
-    return size
+# Folder for caches that should outlive the session
+def cache_dir():
+    return bpy.utils.user_resource(
+        'DATAFILES',
+        path='docview_cache',
+        create=True
+    )
+
+
+# The text datablock shown when 'Use Blender Text Data' is on
+def get_internal_text(name=''):
+    if name in bpy.data.texts:
+        return bpy.data.texts[name]
+    try:
+        text = bpy.data.texts[0]
+    except IndexError:
+        bpy.ops.text.new()
+        text = bpy.data.texts['Text']
+        text.lines[0].body = '# Check out Markdown in Blender!'
+    return text
+
+
+# Cheap fingerprint of the state of a text datablock
+# Typing, pasting and undo all move the cursor or change its line,
+# so the full list of lines is only read when this changes
+def text_signature(text):
+    return (
+        text.name,
+        len(text.lines),
+        text.current_line_index,
+        text.current_character,
+        text.current_line.body,
+        text.select_end_line_index,
+        text.select_end_character,
+    )
+
+
+# What the draw handlers of an area depend on besides the document:
+# its scroll and its size
+def view_state(area):
+    for region in area.regions:
+        if region.type == 'WINDOW':
+            scroll = region.view2d.region_to_view(region.x, region.y)
+            return tuple(scroll), area.width, area.height
+    return None
+
+
+# Scroll an area's view back to where a document was left
+def restore_scroll(context, scroll):
+    state = view_state(context.area)
+    if state is None or scroll is None:
+        return
+    delta_x = int(scroll[0] - state[0][0])
+    delta_y = int(scroll[1] - state[0][1])
+    if delta_x or delta_y:
+        bpy.ops.view2d.pan(deltax=delta_x, deltay=delta_y)
+
+
+# Scroll the Document Viewer area so line index is at its top
+# The view scrolls scroll_factor units for every pixel the text moves
+def scroll_to_line(area, document, index):
+    scroll_factor = 5
+    margin = document.style.base_size
+    for region in area.regions:
+        if region.type != 'WINDOW':
+            continue
+        scroll = region.view2d.region_to_view(region.x, region.y)
+        scale = bpy.context.scene.docview_props.base_size
+        scale /= document.style.base_size
+        current = -min(scroll[1], 0) / scroll_factor
+        target = max(0, document.line_top(index) - margin) * scale
+        delta_y = int((current - target) * scroll_factor)
+        if not delta_y:
+            return
+        override = {'area': area, 'region': region}
+        if hasattr(bpy.context, 'temp_override'):
+            with bpy.context.temp_override(**override):
+                bpy.ops.view2d.pan(deltax=0, deltay=delta_y)
+        else:
+            bpy.ops.view2d.pan(override, deltax=0, deltay=delta_y)
+        return
+
+
+# Number of the line at the top of the Document Viewer area
+def top_line(area, document):
+    scroll_factor = 5
+    for region in area.regions:
+        if region.type == 'WINDOW':
+            scroll = region.view2d.region_to_view(region.x, region.y)
+            break
+    else:
+        return None
+    scale = bpy.context.scene.docview_props.base_size
+    scale /= document.style.base_size
+    top = -min(scroll[1], 0) / scroll_factor / scale
+    return document.line_at(top + document.style.base_size)
+
+
+# Ascending line numbers of the matches of the query in document,
+# None while it is indexed; the first search indexes it
+def search_matches(document):
+    matches = search_state.find(document)
+    if matches is None and search_state.pattern is not None:
+        index_text(document)
+        matches = search_state.find(document)
+        if matches is not None:
+            redraw.request('search')
+    return matches
+
+
+# Line number of the match after, or before, the top of the area,
+# wrapping around at the end of the document; None without matches
+def find_match(area, document, backward=False):
+    matches = search_matches(document)
+    if matches is None or not len(matches):
+        return None
+    current = top_line(area, document)
+    if current is None:
+        return None
+
+    # Binary search of the sorted matches
+    if backward:
+        position = int(np.searchsorted(matches, current, 'left')) - 1
+    else:
+        position = int(np.searchsorted(matches, current, 'right'))
+    return int(matches[position % len(matches)])
+
+
+# Watch the shown file, if any, and the images its lines link to
+def watch_document(document, path=None):
+    paths = [] if path is None else [path]
+    for key in image_keys(document):
+        source = image_cache.sources.get(key)
+        if source is not None:
+            paths.append(source[0])
+    watcher.watch(paths, reload_changed)
+
+
+# Called by the watcher with the files changed since its last poll
+# The document is diffed against the new version of the file, so only
+# changed lines are laid out, and only lines showing a changed image
+def reload_changed(paths):
+    namespace = bpy.app.driver_namespace
+    document = namespace.get('docview_document')
+    key = namespace.get('docview_key')
+    if document is None or key is None:
+        return
+    changed = set(paths)
+
+    path = key[1] if key[0] == 'file' else None
+    stamp = None
+    if path in changed:
+        stamp = file_stamp(path)
+        if stamp is not None:
+            previous = document.source
+            text_lines = open_lines(path, cache_dir())
+            update_text(document, text_lines)
+            # Saved for the new version of the file from now on
+            layout_store.track(
+                document,
+                layout_store.key(text_lines, document.style)
+            )
+            close = getattr(previous, 'close', None)
+            if close is not None and previous is not document.source:
+                close()
+
+    keys = {image_cache.paths.get(changed_path) for changed_path in changed}
+    keys.discard(None)
+    if keys:
+        document.reload_images(keys)
+
+    cached = document_cache.get(key)
+    if cached is not None:
+        document_cache.put(
+            key,
+            document,
+            cached.images,
+            stamp or cached.stamp
+        )
+    watch_document(document, path)
+    redraw.request('content')
+
+
+# Property changes are applied once the value stops changing,
+# so dragging a slider doesn't redo the work on every tick
+DEBOUNCE = 0.15
+
+pending_updates = set()
+# what needs doing once the properties settle
+# 'document' : run Draw Document again
+# 'size' : lay out the current document at the new size
+
+
+def schedule_update(kind):
+    pending_updates.add(kind)
+    if bpy.app.timers.is_registered(apply_updates):
+        bpy.app.timers.unregister(apply_updates)
+    bpy.app.timers.register(apply_updates, first_interval=DEBOUNCE)
+
+
+def apply_updates():
+    kinds = set(pending_updates)
+    pending_updates.clear()
+    document = bpy.app.driver_namespace.get('docview_document')
+
+    if 'document' in kinds or document is None:
+        draw_document()
+    elif 'size' in kinds:
+        reflow_text(bpy.context, document)
+        remember_layout(document)
+        redraw.request('content')
+    return None
+
+
+# Cache the document being shown again after it was laid out at a
+# new size, and save it to the layout store under its new style
+def remember_layout(document):
+    namespace = bpy.app.driver_namespace
+    key = namespace.get('docview_key')
+    cached = document_cache.get(key) if key is not None else None
+    if cached is None:
+        return
+
+    path = key[1] if key[0] == 'file' else None
+    if path is not None and file_stamp(path) == cached.stamp:
+        # Streamed documents read from the file itself, the others
+        # only kept its lines
+        text_lines = document.source
+        if not hasattr(text_lines, 'stat_key'):
+            text_lines = open_lines(path, cache_dir())
+        layout_store.track(
+            document,
+            layout_store.key(text_lines, document.style)
+        )
+        if text_lines is not document.source:
+            text_lines.close()
+        # Saved now if laid out already, by the worker once done otherwise
+        layout_store.save(document)
+
+    document_cache.put(key, document, cached.images, cached.stamp)
+
+
+# Run Draw Document in the first Document Viewer, as if from its header
+def draw_document():
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.ui_type != 'DocumentViewer':
+                continue
+            for region in area.regions:
+                if region.type != 'WINDOW':
+                    continue
+                override = {'window': window, 'area': area, 'region': region}
+                if hasattr(bpy.context, 'temp_override'):
+                    with bpy.context.temp_override(**override):
+                        bpy.ops.docview.draw_document('INVOKE_DEFAULT')
+                else:
+                    bpy.ops.docview.draw_document(override, 'INVOKE_DEFAULT')
+                return
 
 
 def update_func(self, context):
-    bpy.ops.docview.draw_document('INVOKE_DEFAULT')
+    schedule_update('document')
+
+
+# Matches are found and highlighted when the viewers next draw
+def update_search(self, context):
+    search_state.set_query(self.search)
+    redraw.request('search')
+
+
+# Colors are looked up when drawing, a new theme is just a redraw
+def update_theme(self, context):
+    redraw.request('theme')
+
+
+# A new texture budget applies right away, not on the next restyle
+def update_texture_budget(self, context):
+    image_cache.budget = self.texture_budget * 1024 * 1024
+    image_cache.evict()
+    redraw.request('images')
+
+
+# While the size slider is dragged the current layout is scaled to
+# preview the new size, and laid out for real once it settles
+def update_size(self, context):
+    redraw.request('size')
+    schedule_update('size')
+
+
+# Table of contents in the sidebar, one row per heading not
+# inside a folded section, the section being read is highlighted
+def draw_outline(layout, context):
+    document = bpy.app.driver_namespace.get('docview_document')
+    if document is None or not len(document.outline):
+        layout.label(text='No headings')
+        return
+    outline = document.outline
+    current = top_line(context.area, document)
+    if current is not None:
+        current = outline.find(current)
+
+    column = layout.column(align=True)
+    for i in outline.visible():
+        row = column.row(align=True)
+        row.separator(factor=(outline.levels[i] - 1) * 2)
+        if outline.collapsed[i]:
+            icon = 'DISCLOSURE_TRI_RIGHT'
+        else:
+            icon = 'DISCLOSURE_TRI_DOWN'
+        toggle = row.operator(
+            'docview.toggle_section',
+            text='',
+            icon=icon,
+            emboss=False
+        )
+        toggle.index = i
+        jump = row.operator(
+            'docview.jump_to_heading',
+            text=outline.titles[i] or '#',
+            emboss=i == current
+        )
+        jump.index = i
+
+
+# Settings of the viewer in the sidebar, next to the outline
+def draw_settings(layout, context):
+    props = context.scene.docview_props
+    column = layout.column()
+    column.prop(props, 'watch_files', text='Reload Changed Files')
+    column.prop(props, 'texture_budget', text='Texture Memory (MB)')
+    column.prop(props, 'document_budget', text='Document Memory (MB)')
+    column.prop(props, 'store_budget', text='Saved Layouts (MB)')
+    column.prop(props, 'show_stats', text='Show Redraw Stats')
 
 
 def menu_func(self, context):
@@ -20,4 +355,78 @@ def menu_func(self, context):
         layout.operator('docview.draw_document', icon='FILE_TICK')
         layout.prop(props, 'base_size', text='Size')
         layout.prop(props, 'current_theme', text='Theme')
+        if props.current_theme == 'custom':
+            layout.prop(props, 'custom_bg', text='')
+            layout.prop(props, 'custom_block', text='')
+            layout.prop(props, 'custom_text', text='')
+            layout.prop(props, 'custom_link', text='')
         layout.prop(props, 'internal', text='Use Blender Text Data')
+        layout.prop(props, 'glyph_atlas', text='Glyph Atlas')
+
+        row = layout.row(align=True)
+        row.prop(props, 'search', text='', icon='VIEWZOOM')
+        backward = row.operator('docview.find_match', text='', icon='TRIA_UP')
+        backward.backward = True
+        row.operator('docview.find_match', text='', icon='TRIA_DOWN')
+        document = bpy.app.driver_namespace.get('docview_document')
+        if document is not None and search_state.pattern is not None:
+            matches = search_matches(document)
+            if matches is None:
+                row.label(text='Indexing')
+            else:
+                row.label(text=f'{len(matches)} lines')
+        if props.internal:
+            layout.prop_search(props, 'text_name', bpy.data, 'texts', text='')
+        else:
+            # One tab per open document
+            row = layout.row(align=True)
+            for index, document in enumerate(props.documents):
+                tab = row.operator(
+                    'docview.switch_document',
+                    text=document.name,
+                    depress=index == props.active_document
+                )
+                tab.index = index
+            row.operator('docview.open_document', text='', icon='ADD')
+            if props.documents:
+                row.operator('docview.close_document', text='', icon='X')
+        if props.show_stats:
+            layout.label(
+                text=f'Redraws: {redraw.issued} issued, '
+                f'{redraw.skipped} skipped'
+            )
+            layout.label(
+                text=f'Fonts: {font_registry.loads} loaded in '
+                f'{font_registry.load_time * 1000:.1f} ms, '
+                f'{font_registry.hits} reused'
+            )
+            layout.label(
+                text=f'Watching {len(watcher.order)} files: '
+                f'{watcher.stats} stats in '
+                f'{watcher.poll_time * 1000:.1f} ms, '
+                f'{watcher.changes} changes'
+            )
+            layout.label(
+                text=f'Background jobs: {layout_worker.finished} '
+                f'finished, {layout_worker.cancelled} cancelled, last '
+                f'{layout_worker.last_time * 1000:.0f} ms'
+            )
+            layout.label(
+                text=f'Documents: {len(document_cache.entries)} cached, '
+                f'{document_cache.used // 1024} KB, '
+                f'{document_cache.hits} hits, '
+                f'{document_cache.misses} misses, '
+                f'{document_cache.evictions} evicted'
+            )
+            layout.label(
+                text=f'Saved layouts: {layout_store.hits} loaded, '
+                f'{layout_store.misses} missing, '
+                f'{layout_store.saves} saved, '
+                f'{layout_store.evictions} deleted'
+            )
+            if props.glyph_atlas:
+                layout.label(
+                    text=f'Glyph atlas: {len(glyph_atlas.glyphs)} glyphs, '
+                    f'{glyph_atlas.generation} restarts, '
+                    f'{text_glyphs.built} batch sets made'
+                )
@@ -0,0 +1,109 @@
+import keyword
+import re
+from . Memo import LRU
+
+
+# Syntax highlighting of the lines of fenced code blocks
+# A line is highlighted on its own, from the state the line above
+# left the highlighter in, so an edit inside a block only highlights
+# the lines it changed again.
+
+# Color roles of highlighted code, following the roles in Layout
+KEYWORD = 5
+STRING = 6
+COMMENT = 7
+NUMBER = 8
+SPECIAL = 9
+
+PYTHON_LANGUAGES = ('python', 'py', 'python3', 'py3')
+
+PYTHON_KEYWORDS = frozenset(keyword.kwlist)
+
+PYTHON_TOKEN = re.compile(r'''
+    (?P<comment>\#.*)
+  | (?P<string>[rRbBuUfF]{0,2}(?:"""|\'\'\'|"|'))
+  | (?P<number>(?:0[xXoObB][0-9a-fA-F_]+|(?:\d[\d_]*\.?[\d_]*|\.\d[\d_]*)
+        (?:[eE][+-]?\d+)?[jJ]?))
+  | (?P<decorator>@[^\W\d][\w.]*)
+  | (?P<name>[^\W\d]\w*)
+''', re.VERBOSE)
+
+# Rest of a string after its opening quotes, up to the closing ones
+STRING_END = {
+    quotes: re.compile(rf'(?:\\.|[^\\])*?{quotes}', re.DOTALL)
+    for quotes in ('"""', "'''", '"', "'")
+}
+
+# Highlighted lines, shared by every layout
+# Resizing, relayout and scrolling look lines up here instead of
+# highlighting them again
+MAX_CODE_LINES = 16384
+
+code_tokens = LRU(MAX_CODE_LINES)
+# key : value
+# (language, state, text) : (runs, state after the line)
+
+
+# Colored runs of a line of Python, and the state for the next line
+# The state is the quotes of a string still open at the end of the
+# line, None otherwise
+def highlight_python(text, state=None):
+    runs = []
+    # (start, end, color role)
+    position = 0
+
+    if state is not None:
+        end = STRING_END[state].match(text)
+        if end is None:
+            return ((0, len(text), STRING),), state
+        runs.append((0, end.end(), STRING))
+        position = end.end()
+        state = None
+
+    definition = False
+    while True:
+        token = PYTHON_TOKEN.search(text, position)
+        if token is None:
+            break
+        kind = token.lastgroup
+        start, position = token.span()
+        if kind == 'string':
+            quotes = token.group().lstrip('rRbBuUfF')
+            end = STRING_END[quotes].match(text, position)
+            if end is not None:
+                position = end.end()
+            else:
+                # Triple quotes go on over the next lines
+                if len(quotes) == 3:
+                    state = quotes
+                position = len(text)
+            runs.append((start, position, STRING))
+        elif kind == 'name':
+            if definition:
+                runs.append((start, position, SPECIAL))
+            elif token.group() in PYTHON_KEYWORDS:
+                runs.append((start, position, KEYWORD))
+            definition = token.group() in ('def', 'class')
+            continue
+        else:
+            runs.append((start, position, {
+                'comment': COMMENT,
+                'number': NUMBER,
+                'decorator': SPECIAL,
+            }[kind]))
+        definition = False
+    return tuple(runs), state
+
+
+# Colored runs of a line of code in language, and the highlighter
+# state for the line below, memoized
+# Runs are (start, end, color role), text between them is plain
+def highlight_line(language, text, state=None):
+    if language not in PYTHON_LANGUAGES:
+        return (), None
+
+    key = (language, state, text)
+    entry = code_tokens.get(key)
+    if entry is None:
+        entry = code_tokens.put(key, highlight_python(text, state))
+    return entry
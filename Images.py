@@ -0,0 +1,306 @@
+import bpy
+import gpu
+import hashlib
+import math
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
+from PIL import Image
+from . Redraw import redraw
+
+
+# Resolve an image url from a markdown link to a file on disk
+# Urls starting with '/' are relative to the document's folder,
+# which is how the links in sample.md are written
+def resolve_path(folder, url):
+    if '://' in url:
+        return None
+    if os.path.isabs(url) and os.path.exists(url):
+        return os.path.normpath(url)
+    parts = [part for part in url.replace('\\', '/').split('/') if part]
+    return os.path.normpath(os.path.join(folder, *parts))
+
+
+# Hash of the file contents, so the same picture linked from two
+# places, or under two names, is only loaded once
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Mip level an image is decoded at: every level halves the resolution,
+# and the decoded image is never smaller than it is drawn
+def mip_level(full_width, drawn_width):
+    if drawn_width <= 0 or full_width <= drawn_width:
+        return 0
+    return int(math.log2(full_width / drawn_width))
+
+
+# Runs on a worker thread: decode, downsample and convert to the
+# float pixels gpu textures are created from
+def decode_image(path, level):
+    with Image.open(path) as image:
+        width, height = image.size
+        width = max(1, width >> level)
+        height = max(1, height >> level)
+        # Lets JPEG decode straight to a smaller scale
+        image.draft('RGB', (width, height))
+        image = image.convert('RGBA')
+        if image.size != (width, height):
+            image = image.resize((width, height), Image.BILINEAR)
+        # Textures start at the bottom left
+        image = image.transpose(Image.FLIP_TOP_BOTTOM)
+        pixels = np.frombuffer(image.tobytes(), dtype=np.uint8)
+    pixels = pixels.astype(np.float32) / 255
+    return width, height, pixels
+
+
+# Content-addressed cache of decoded images and gpu textures
+# shared by every layout. Images are decoded on a worker pool at the
+# mip level they are drawn at, and only uploaded from the main thread.
+class ImageCache:
+    def __init__(self, budget=256 * 1024 * 1024, workers=2):
+        # Most bytes of texture memory kept resident
+        self.budget = budget
+        self.used = 0
+        self.workers = workers
+        self.executor = None
+
+        self.digests = {}
+        # key : value
+        # (path, mtime, size) : content digest
+
+        self.paths = {}
+        # key : value
+        # path : content digest last loaded from it
+
+        self.sources = {}
+        # key : value
+        # content digest : (path, full width, full height)
+
+        self.pending = {}
+        # key : value
+        # (content digest, mip level) : future of decode_image
+
+        self.textures = OrderedDict()
+        # key : value
+        # (content digest, mip level) : (gpu texture, bytes)
+        # least recently drawn first
+
+        self.resident = {}
+        # key : value
+        # content digest : mip level of its most recent texture
+
+        self.visible = {}
+        # key : value
+        # area pointer : digests of the images it last drew,
+        # never evicted so a small budget can't reupload them each frame
+
+        self.stale = []
+        # digests of replaced files, forgotten on the main thread since
+        # layouts, and so load, can run on a worker thread
+
+    def digest(self, path):
+        stat = os.stat(path)
+        stat_key = (path, stat.st_mtime_ns, stat.st_size)
+        if stat_key not in self.digests:
+            self.digests[stat_key] = file_digest(path)
+        return self.digests[stat_key]
+
+    # Called during layout: only the image header is read,
+    # the pixels are decoded later, when the image is drawn
+    def load(self, path):
+        if path is None or not os.path.exists(path):
+            return None
+
+        try:
+            key = self.digest(path)
+            if key not in self.sources:
+                with Image.open(path) as image:
+                    width, height = image.size
+                self.sources[key] = (path, width, height)
+        except OSError:
+            return None
+
+        # The file behind this path changed since it was last loaded
+        previous = self.paths.get(path)
+        if previous is not None and previous != key:
+            self.stale.append(previous)
+        self.paths[path] = key
+
+        path, width, height = self.sources[key]
+        return key, width, height
+
+    # Texture for an image drawn at drawn_width pixels
+    # Returns None until a texture of any level is ready; while the
+    # right level decodes the closest resident one is used
+    def texture(self, key, drawn_width=0):
+        while self.stale:
+            self.forget(self.stale.pop())
+
+        source = self.sources.get(key)
+        if source is None:
+            return None
+
+        level = mip_level(source[1], drawn_width)
+        wanted = (key, level)
+        if wanted in self.textures:
+            self.textures.move_to_end(wanted)
+            return self.textures[wanted][0]
+
+        self.request(key, level)
+
+        fallback = self.resident.get(key)
+        if fallback is not None:
+            self.textures.move_to_end((key, fallback))
+            return self.textures[(key, fallback)][0]
+        return None
+
+    def request(self, key, level):
+        if (key, level) in self.pending:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix='docview_images'
+            )
+        path = self.sources[key][0]
+        future = self.executor.submit(decode_image, path, level)
+        self.pending[(key, level)] = future
+
+        if not bpy.app.timers.is_registered(upload_textures):
+            bpy.app.timers.register(upload_textures, first_interval=0.02)
+
+    # Timer on the main thread: turn finished decodes into textures
+    def upload(self):
+        uploaded = False
+        for wanted, future in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[wanted]
+            try:
+                width, height, pixels = future.result()
+            except Exception as error:
+                print(f'Could not decode image: {error}')
+                continue
+            if wanted[0] not in self.sources:
+                continue
+
+            buffer = gpu.types.Buffer('FLOAT', len(pixels), pixels)
+            texture = gpu.types.GPUTexture(
+                (width, height),
+                format='RGBA8',
+                data=buffer
+            )
+            self.store(wanted, texture, width * height * 4)
+            uploaded = True
+
+        if uploaded:
+            redraw.request('images')
+        if self.pending:
+            return 0.02
+        return None
+
+    def store(self, wanted, texture, size):
+        key, level = wanted
+        # Only one level per image is kept resident
+        previous = self.resident.get(key)
+        if previous is not None:
+            self.release_level(key, previous)
+
+        self.textures[wanted] = (texture, size)
+        self.resident[key] = level
+        self.used += size
+        self.evict(keep=wanted)
+
+    # Images an area draws this frame, in place of the last ones
+    def show(self, area, keys):
+        self.visible[area] = set(keys)
+
+    # Release least recently drawn textures until under budget,
+    # images in view stay even if that leaves it over
+    def evict(self, keep=None):
+        shown = set().union(*self.visible.values())
+        for wanted in list(self.textures):
+            if self.used <= self.budget:
+                break
+            if wanted != keep and wanted[0] not in shown:
+                self.release_level(*wanted)
+
+    def release_level(self, key, level):
+        texture, size = self.textures.pop((key, level), (None, 0))
+        self.used -= size
+        if self.resident.get(key) == level:
+            del self.resident[key]
+
+    # Free the gpu memory of an image scrolled far out of view
+    # It is decoded again when it comes back
+    def release(self, key):
+        level = self.resident.get(key)
+        if level is not None:
+            self.release_level(key, level)
+        for wanted in [w for w in self.pending if w[0] == key]:
+            self.pending.pop(wanted).cancel()
+
+    def forget(self, key):
+        self.release(key)
+        self.sources.pop(key, None)
+
+    def clear(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if bpy.app.timers.is_registered(upload_textures):
+            bpy.app.timers.unregister(upload_textures)
+        self.textures.clear()
+        self.resident.clear()
+        self.stale.clear()
+        self.visible.clear()
+        self.used = 0
+        self.digests.clear()
+        self.paths.clear()
+        self.sources.clear()
+
+
+image_cache = ImageCache()
+
+
+def upload_textures():
+    return image_cache.upload()
+
+
+# Image backend used by the layout engine inside Blender
+# load() gives the layout an image size, texture() gives the draw
+# handlers something to bind, so neither side needs the other
+class BlenderImageLoader:
+    def __init__(self, folder, cache=image_cache):
+        self.folder = folder
+        self.cache = cache
+
+    def load(self, url):
+        return self.cache.load(resolve_path(self.folder, url))
+
+    def texture(self, key, drawn_width=0):
+        return self.cache.texture(key, drawn_width)
+
+    def release(self, key):
+        self.cache.release(key)
+
+    def show(self, area, keys):
+        self.cache.show(area, keys)
+
+    def resident(self):
+        return list(self.cache.resident)
+
+
+@lru_cache(maxsize=8)
+def get_image_loader(folder):
+    return BlenderImageLoader(folder)
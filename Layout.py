@@ -0,0 +1,787 @@
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+import numpy as np
+from . Highlight import highlight_line
+from . Markdown import parse_line, HEADING, BULLET, ORDERED, QUOTE, CODE_LINE
+from . Markdown import CODE_SPAN, LINK_SPAN, IMAGE_SPAN
+from . Memo import LRU
+
+
+# The layout engine is pure Python: it never touches bpy, gpu or blf,
+# so it can be profiled, cached and run outside of a live Blender UI.
+# Fonts are referred to by role, measurement goes through a metrics
+# provider and images through a pluggable loader.
+#
+# Every source line is laid out on its own, relative to the top of
+# that line, so an edit only needs the changed lines laid out again
+# and the lines below moved down or up.
+
+REGULAR = 'regular'
+ITALIC = 'italic'
+BOLD = 'bold'
+CODE = 'code'
+
+FONT_ROLES = (REGULAR, ITALIC, BOLD, CODE)
+
+# Color roles, resolved against the active theme at draw time,
+# in the order the colors are listed in every theme
+BACKGROUND = 0
+BLOCK = 1
+TEXT = 2
+LINK = 3
+HIGHLIGHT = 4
+# KEYWORD, STRING, COMMENT, NUMBER and SPECIAL of highlighted code
+# come next, see Highlight
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif')
+
+# Marker of list items, by nesting depth
+BULLETS = ('◦', '•', '∙')
+
+# Font role of text by Markdown emphasis: plain text keeps the
+# font of its line, emphasis is italic and strong is bold
+EMPHASIS_FONTS = (None, ITALIC, BOLD)
+
+
+# Line level formatting
+# e.g. headers, regular text, full lines in italic or bold
+Line = namedtuple('Line', [
+    'text',   # 0 : the text of the line
+    'font',   # 1 : font role, resolved to a blf font at draw time
+    'size',   # 2 : font size of the text
+    'color',  # 3 : color role of the text
+    'x',      # 4 : horizontal offset of the line
+    'y',      # 5 : vertical offset of the line
+    'link',   # 6 : boolean, true if a link is found
+    'image',  # 7 : boolean, true if an image is found
+    'spans',  # 8 : tuple of Span, drawn with one blf call each
+])
+
+# Sub-line formatting
+# A contiguous run of same-style text within a line, e.g. a link
+Span = namedtuple('Span', [
+    'text',   # 0 : the text of the run
+    'color',  # 1 : color role of the text
+    'x',      # 2 : horizontal offset of the run
+    'font',   # 3 : font role of the run, e.g. emphasis within the line
+])
+
+Image = namedtuple('Image', [
+    'key',     # 0 : handle returned by the image loader
+    'width',   # 1 : image width
+    'height',  # 2 : image height
+    'x',       # 3 : image x start position
+    'y',       # 4 : image y start position
+])
+
+CodeBlock = namedtuple('CodeBlock', ['x', 'y', 'length'])
+
+QuoteBlock = namedtuple('QuoteBlock', ['x', 'y'])
+
+# Code context of a line inside a fenced code block
+Fence = namedtuple('Fence', [
+    'language',  # language named after the opening ```, lower case
+    'state',     # highlighter state at the start of the line
+])
+
+# Layout of a single source line
+# All y offsets inside are measured down from the top of the line
+LineLayout = namedtuple('LineLayout', [
+    'source',        # the markdown text the layout was made from
+    'after_code',    # code context left by the line above, see code_after
+    'lines',         # tuple of Line
+    'images',        # tuple of Image
+    'code_blocks',   # tuple of CodeBlock
+    'quote_blocks',  # tuple of QuoteBlock
+    'height',        # distance to the top of the next line
+    'width',         # widest x reached by the line
+    'wrap',          # (low, high) viewport widths the line breaks hold for
+])
+
+DisplayList = namedtuple('DisplayList', [
+    'layouts',    # tuple of LineLayout, one per source line
+    'tops',       # y offset of the top of each LineLayout, ascending
+    'width',      # widest x reached by the layout
+    'height',     # total height of the document
+    'viewport',   # (width, height) the layout was made for
+    'base_size',  # base font size the layout was made with
+    'first',      # number of the source line of the first layout
+])
+
+# Every span of a display list in flat typed arrays, one entry per span
+# The texts are joined into one string and sliced with start and end,
+# so culling and scrolling are a few array operations per frame
+SpanTable = namedtuple('SpanTable', [
+    'x',      # float32 : x offset of the span
+    'y',      # float64 : y offset from the top of the document, ascending
+    'size',   # float64 : font size, exactly as laid out
+    'font',   # uint8   : index of the font role in FONT_ROLES
+    'color',  # uint8   : color role
+    'start',  # uint32  : start of the span's text in text
+    'end',    # uint32  : end of the span's text in text
+    'line',   # uint32  : index in the display list of the span's layout
+    'text',   # str     : text of every span, one after the other
+])
+
+# Everything shared by all the lines of one layout
+LayoutStyle = namedtuple('LayoutStyle', [
+    'metrics',     # provider with offsets(text, font, size)
+    'base_size',   # the base size for all drawing: font, offset, image
+    'images',      # loader with load(url) -> (key, width, height) or None
+])
+
+
+# Image loader used when no backend is given: images keep their space
+# in the document but nothing is loaded
+class NullImageLoader:
+    def load(self, url):
+        return None
+
+
+def make_style(metrics, base_size, images=None):
+    if images is None:
+        images = NullImageLoader()
+    return LayoutStyle(metrics, base_size, images)
+
+
+# Space above the first line of the document
+def top_margin(base_size):
+    return base_size + base_size / 2 + base_size / 4
+
+
+def is_code(text):
+    return text.startswith('`')
+
+
+def is_fence(text):
+    return text.startswith('```')
+
+
+# Every line is laid out in the code context the line above left:
+#   False : not code
+#   True  : after a one line code block, or the closing fence
+#   Fence : inside a fenced code block
+# Returns the context of the line below text
+def code_after(text, after_code=False):
+    if isinstance(after_code, Fence):
+        if is_fence(text):
+            return True
+        runs, state = highlight_line(
+            after_code.language,
+            text.expandtabs(4),
+            after_code.state
+        )
+        return Fence(after_code.language, state)
+    if is_fence(text):
+        return Fence(text[3:].strip().lower(), None)
+    return is_code(text)
+
+
+# Level of a markdown heading, 1 to 6, or 0 if text isn't one
+# Any line starting with '#' is laid out as a heading
+def heading_level(text):
+    if not text.startswith('#'):
+        return 0
+    return min(len(text) - len(text.lstrip('#')), 6)
+
+
+# Font size of a heading of level 1 to 6
+def heading_size(base_size, level):
+    double = base_size * 2
+    half = base_size / 2
+    third = base_size / 3
+    sixth = base_size / 6
+    eigth = base_size / 8
+    return (
+        double + sixth,
+        double,
+        base_size + half + third,
+        base_size + half + sixth,
+        base_size + third,
+        base_size + eigth,
+    )[level - 1]
+
+
+# Stand-in for a line inside a folded section: nothing to draw,
+# no height, and never laid out until the section is unfolded
+def hidden_layout(line, after_code=False):
+    return LineLayout(line, after_code, (), (), (), (), 0, 0, (0, math.inf))
+
+
+# Range of LineLayouts overlapping top <= y <= bottom, as (first, last + 1)
+# A line's content stays between its own top and the next line's top
+def visible_range(tops, top, bottom):
+    first = max(0, bisect_right(tops, top) - 1)
+    last = bisect_left(tops, bottom)
+    return first, max(first, last)
+
+
+# Line breaks of wrapped paragraphs, shared by every layout
+# Each paragraph keeps its character offsets and every set of breaks
+# worked out for it, with the range of widths that gives those breaks
+MAX_PARAGRAPHS = 16384
+MAX_WRAPS = 8
+
+line_breaks = LRU(MAX_PARAGRAPHS)
+# key : value
+# (metrics, text, fonts, size) : (char offsets, [(low, high, breaks)])
+
+
+# Greedy line breaking of text into rows no wider than width
+# Returns the (start, end) of every row and the [low, high) range
+# of widths that give exactly the same rows
+def break_text(text, offsets, width):
+    length = len(text)
+    rows = []
+    low = 0
+    high = math.inf
+    start = 0
+    while True:
+        origin = offsets[start]
+        end = bisect_right(offsets, origin + width) - 1
+        if end >= length:
+            rows.append((start, length))
+            low = max(low, offsets[length] - origin)
+            break
+
+        space = text.rfind(' ', start, end + 1)
+        if space > start:
+            # Break at the last space that fits, it stays there
+            # until the word after it fits too
+            rows.append((start, space))
+            following = text.find(' ', space + 1)
+            if following < 0:
+                following = length
+            low = max(low, offsets[space] - origin)
+            high = min(high, offsets[following] - origin)
+            start = space + 1
+            while start < length and text[start] == ' ':
+                start += 1
+        else:
+            # A word wider than the row is cut where it overflows
+            cut = max(end, start + 1)
+            rows.append((start, cut))
+            low = max(low, offsets[end] - origin)
+            high = min(high, offsets[end + 1] - origin)
+            start = cut
+        if start >= length:
+            break
+    return tuple(rows), low, high
+
+
+# Character offsets of text set in one font role, or in several
+# given as ((end, font role), ...), each part measured on its own
+def text_offsets(metrics, text, fonts, size):
+    if isinstance(fonts, str):
+        return metrics.offsets(text, fonts, size)
+    offsets = [0.0]
+    start = 0
+    for end, font in fonts:
+        origin = offsets[-1]
+        part = metrics.offsets(text[start:end], font, size)
+        offsets += [origin + x for x in part[1:]]
+        start = end
+    return offsets
+
+
+# Line breaks of text are memoized with its character offsets
+def line_entry(metrics, text, fonts, size):
+    key = (metrics, text, fonts, size)
+    entry = line_breaks.get(key)
+    if entry is None:
+        offsets = array('f', text_offsets(metrics, text, fonts, size))
+        entry = line_breaks.put(key, (offsets, []))
+    return entry
+
+
+# Character offsets and rows of text wrapped to width, memoized
+# Resizing only breaks a paragraph again when width leaves the range
+# its rows hold for, and even then a previous result is often reused
+def wrap_text(metrics, text, fonts, size, width):
+    entry = line_entry(metrics, text, fonts, size)
+    offsets, wraps = entry
+    for low, high, rows in wraps:
+        if low <= width < high:
+            return offsets, rows, (low, high)
+
+    rows, low, high = break_text(text, offsets, width)
+    wraps.append((low, high, rows))
+    if len(wraps) > MAX_WRAPS:
+        wraps.pop(0)
+    return offsets, rows, (low, high)
+
+
+# Lay out a line of a fenced code block, or one of its fences
+# Code is never wrapped, its spans are the highlighted runs of the line
+def layout_fenced(style, line, after_code=False):
+    metrics = style.metrics
+    base_size = style.base_size
+    sixth = base_size / 6
+
+    offset_x = base_size
+    offset_y = 0
+    # A little extra space above the opening fence
+    if not after_code:
+        offset_y += sixth
+
+    runs = ()
+    code = ''
+    text = ''
+    if isinstance(after_code, Fence) and not is_fence(line):
+        code = line.expandtabs(4)
+        runs, state = highlight_line(
+            after_code.language,
+            code,
+            after_code.state
+        )
+        text = f' {code}'
+    code_blocks = (CodeBlock(offset_x, offset_y, len(text)),)
+
+    offset_x = base_size + sixth
+    offset_y += sixth
+
+    # Runs of the same color make one span, spaces between them
+    # don't break it, so a line is a handful of spans to draw
+    pieces = []
+    # [start, color] of every span in text
+
+    def add(start, color):
+        if not pieces:
+            pieces.append([0, color])
+        elif pieces[-1][1] != color:
+            pieces.append([start, color])
+
+    position = 0
+    for start, end, color in runs:
+        gap = code[position:start]
+        if gap and not gap.isspace():
+            add(position + 1, TEXT)
+        add(start + 1, color)
+        position = end
+    if code[position:].strip():
+        add(position + 1, TEXT)
+
+    width = 0
+    spans = ()
+    if len(pieces) > 1:
+        char_offsets = metrics.offsets(text, CODE, base_size)
+        ends = [start for start, color in pieces[1:]] + [len(text)]
+        spans = tuple(
+            Span(text[start:end], color, offset_x + char_offsets[start], CODE)
+            for (start, color), end in zip(pieces, ends)
+        )
+        width = offset_x + char_offsets[len(text)]
+    elif text:
+        color = pieces[0][1] if pieces else TEXT
+        spans = (Span(text, color, offset_x, CODE),)
+
+    draw_line = Line(
+        text,
+        CODE,
+        base_size,
+        TEXT,
+        offset_x,
+        offset_y,
+        False,
+        False,
+        spans
+    )
+    offset_y += base_size + sixth
+
+    return LineLayout(
+        line,
+        after_code,
+        (draw_line,),
+        (),
+        code_blocks,
+        (),
+        offset_y,
+        width,
+        (0, math.inf)
+    )
+
+
+# Lay out a single markdown line, relative to its top
+# Text wider than wrap_width is wrapped onto more rows,
+# code lines and a wrap_width of None are never wrapped
+def layout_line(style, line, after_code=False, wrap_width=None):
+    if isinstance(after_code, Fence) or is_fence(line):
+        return layout_fenced(style, line, after_code)
+
+    source = line
+    metrics = style.metrics
+    base_size = style.base_size
+
+    # Derive all scale elements from the base font size
+    half = base_size / 2
+    sixth = base_size / 6
+
+    image_list = []
+    code_blocks = []
+    quote_blocks = []
+
+    font = REGULAR
+    text_size = base_size
+    width = 0
+
+    offset_x = half
+    offset_y = 0
+    indent = 0
+
+    block = parse_line(line)
+    kind = block.kind
+    code_block = kind == CODE_LINE
+    quote_block = kind == QUOTE
+
+    # Text drawn before the tokens of the line
+    prefix = ''
+
+    # Format Headers
+    if kind == HEADING:
+        font = BOLD
+        text_size = heading_size(base_size, block.level)
+        offset_y += text_size
+
+    # Format Bullets and numbered items, nested by indent
+    elif kind == BULLET:
+        prefix = f'{BULLETS[min(block.level, len(BULLETS) - 1)]} '
+        indent = block.level * base_size
+    elif kind == ORDERED:
+        prefix = f'{block.marker}. '
+        indent = block.level * base_size
+
+    elif code_block:
+        prefix = ' '
+        offset_x = base_size
+        # A little extra space above the first line of a code block
+        if not after_code:
+            offset_y += sixth
+        font = CODE
+
+    elif quote_block:
+        prefix = '  '
+        offset_x = base_size
+        quote_blocks.append(QuoteBlock(offset_x, offset_y))
+
+    # Determine X, Y offsets for drawing lines
+    if text_size == base_size:
+        offset_y += sixth
+        offset_x = base_size + sixth + indent
+    else:
+        offset_x = half
+
+    # Split the tokens into runs of one color and font
+    # Links and code spans keep the font of the emphasis they are in
+    texts = [prefix]
+    runs = []
+    # [start, end, color, font]
+    position = len(prefix)
+    if prefix:
+        runs.append([0, position, TEXT, font])
+    sub_line = False
+    image_urls = []
+    for kind, text, url, emphasis in block.tokens:
+        color = TEXT
+        if kind == CODE_SPAN:
+            run_font = CODE
+        else:
+            run_font = EMPHASIS_FONTS[emphasis] or font
+            if kind == LINK_SPAN or kind == IMAGE_SPAN:
+                sub_line = True
+                if url.lower().endswith(IMAGE_EXTENSIONS):
+                    image_urls.append(url)
+                    continue
+                color = LINK
+        if not text:
+            continue
+        end = position + len(text)
+        last = runs[-1] if runs else None
+        if last is not None and last[2] == color and last[3] == run_font:
+            last[1] = end
+        else:
+            runs.append([position, end, color, run_font])
+        texts.append(text)
+        position = end
+
+    # Format Images, a line with images only shows the images
+    image_line = bool(image_urls)
+    for url in image_urls:
+        loaded = style.images.load(url)
+        if loaded is not None:
+            key, image_width, image_height = loaded
+            image_width *= base_size / 24
+            image_height *= base_size / 24
+            image_list.append(Image(
+                key,
+                image_width,
+                image_height,
+                offset_x,
+                offset_y
+            ))
+            width = max(width, offset_x + image_width)
+            offset_y += image_height
+    if image_line:
+        texts = []
+        runs = []
+
+    line = ''.join(texts)
+    if not runs:
+        runs.append([0, 0, TEXT, font])
+
+    # Runs in more than one font are measured a font at a time
+    fonts = font
+    if len(runs) > 1 and any(run[3] != runs[0][3] for run in runs):
+        fonts = []
+        # (end, font) of every change of font
+        for start, end, color, run_font in runs:
+            if fonts and fonts[-1][1] == run_font:
+                fonts[-1] = (end, run_font)
+            else:
+                fonts.append((end, run_font))
+        fonts = tuple(fonts)
+
+    if code_block:
+        code_blocks.append(CodeBlock(base_size, offset_y - sixth, len(line)))
+
+    # Everything left and right of the text is kept clear
+    reserved = offset_x + half
+    if wrap_width is None or code_block or not line:
+        rows = ((0, len(line)),)
+        wrap = (0, math.inf)
+        char_offsets = None
+        if len(runs) > 1:
+            char_offsets = line_entry(metrics, line, fonts, text_size)[0]
+    else:
+        char_offsets, rows, (low, high) = wrap_text(
+            metrics,
+            line,
+            fonts,
+            text_size,
+            wrap_width - reserved
+        )
+        wrap = (low + reserved, high + reserved)
+
+    # Every row is a Line of its own, the spans are cut at the breaks
+    row_height = text_size + sixth
+    draw_lines = []
+    for row, (row_start, row_end) in enumerate(rows):
+        row_y = offset_y + row * row_height
+        if char_offsets is None:
+            start, end, color, run_font = runs[0]
+            spans = (Span(line, color, offset_x, run_font),) if line else ()
+        else:
+            origin = char_offsets[row_start]
+            spans = []
+            for start, end, color, run_font in runs:
+                start = max(start, row_start)
+                end = min(end, row_end)
+                if start < end:
+                    spans.append(Span(
+                        line[start:end],
+                        color,
+                        offset_x + char_offsets[start] - origin,
+                        run_font
+                    ))
+            spans = tuple(spans)
+            width = max(width, offset_x + char_offsets[row_end] - origin)
+
+        draw_lines.append(Line(
+            line[row_start:row_end],
+            font,
+            text_size,
+            TEXT,
+            offset_x,
+            row_y,
+            sub_line,
+            image_line,
+            spans
+        ))
+        if quote_block and row:
+            first_quote = quote_blocks[0]
+            quote_blocks.append(QuoteBlock(
+                first_quote.x,
+                first_quote.y + row * row_height
+            ))
+
+    offset_y += (len(rows) - 1) * row_height
+    offset_y += base_size + sixth
+
+    return LineLayout(
+        source,
+        after_code,
+        tuple(draw_lines),
+        tuple(image_list),
+        tuple(code_blocks),
+        tuple(quote_blocks),
+        offset_y,
+        width,
+        wrap
+    )
+
+
+# Lay out lines one after the other, yielding each LineLayout
+def iter_layouts(style, text_lines, after_code=False, wrap_width=None):
+    for line in text_lines:
+        yield layout_line(style, line, after_code, wrap_width)
+        after_code = code_after(line, after_code)
+
+
+# Top of every layout, from the top margin and each layout's height
+def stack_layouts(layouts, base_size):
+    tops = []
+    offset_y = top_margin(base_size)
+    width = 0
+    for layout in layouts:
+        tops.append(offset_y)
+        offset_y += layout.height
+        width = max(width, layout.width)
+    return tops, offset_y, width
+
+
+# Lay out the lines of a markdown document into an immutable display list
+#   text_lines : sequence of str
+#   metrics    : provider with offsets(text, font, size)
+#   viewport   : (width, height) of the region being drawn into
+#   images     : loader with load(url) -> (key, width, height) or None
+def layout_document(
+        text_lines,
+        metrics,
+        viewport,
+        base_size,
+        images=None):
+    style = make_style(metrics, base_size, images)
+    layouts = tuple(iter_layouts(style, text_lines, wrap_width=viewport[0]))
+    tops, height, width = stack_layouts(layouts, base_size)
+    return DisplayList(
+        layouts,
+        tuple(tops),
+        width,
+        height,
+        tuple(viewport),
+        base_size,
+        0
+    )
+
+
+# Cut a span where pattern matches, the matches in the HIGHLIGHT role
+# Yields (text, color, x) for every piece
+def highlight_span(span, pattern, metrics, size):
+    position = 0
+    offsets = None
+    for match in pattern.finditer(span.text):
+        if offsets is None:
+            offsets = metrics.offsets(span.text, span.font, size)
+        start, end = match.span()
+        if position < start:
+            x = span.x + offsets[position]
+            yield span.text[position:start], span.color, x
+        yield span.text[start:end], HIGHLIGHT, span.x + offsets[start]
+        position = end
+    if position < len(span.text):
+        x = span.x + offsets[position] if offsets else span.x
+        yield span.text[position:], span.color, x
+
+
+# Flatten the spans of a display list into a SpanTable
+# Only the layouts at the given indices are packed when indices is
+# given, and the words matching pattern, if any, are highlighted
+def pack_spans(display, indices=None, pattern=None, metrics=None):
+    def column(values, dtype):
+        if not values:
+            return np.zeros(0, dtype)
+        return np.frombuffer(values, dtype=dtype)
+
+    if indices is None:
+        indices = range(len(display.layouts))
+
+    font_index = {role: i for i, role in enumerate(FONT_ROLES)}
+    xs = array('f')
+    ys = array('d')
+    sizes = array('d')
+    fonts = array('B')
+    colors = array('B')
+    ends = array('I')
+    layout_indices = array('I')
+    texts = []
+    position = 0
+    for index in indices:
+        top = display.tops[index]
+        for line in display.layouts[index].lines:
+            y = top + line.y
+            for span in line.spans:
+                font = font_index[span.font]
+                if pattern is None:
+                    pieces = ((span.text, span.color, span.x),)
+                else:
+                    pieces = highlight_span(
+                        span,
+                        pattern,
+                        metrics,
+                        line.size
+                    )
+                for text, color, x in pieces:
+                    xs.append(x)
+                    ys.append(y)
+                    sizes.append(line.size)
+                    fonts.append(font)
+                    colors.append(color)
+                    layout_indices.append(index)
+                    texts.append(text)
+                    position += len(text)
+                    ends.append(position)
+
+    end = column(ends, np.uint32)
+    start = np.zeros_like(end)
+    start[1:] = end[:-1]
+
+    return SpanTable(
+        column(xs, np.float32),
+        column(ys, np.float64),
+        column(sizes, np.float64),
+        column(fonts, np.uint8),
+        column(colors, np.uint8),
+        start,
+        end,
+        column(layout_indices, np.uint32),
+        ''.join(texts)
+    )
+
+
+# Indices of the spans with any part in top <= y <= bottom
+# The y of a span is its baseline, its text reaches size above it
+def visible_spans(table, top, bottom):
+    first = int(np.searchsorted(table.y, top, 'left'))
+    reach = float(table.size.max()) if len(table.size) else 0
+    last = int(np.searchsorted(table.y, bottom + reach, 'right'))
+    inside = table.y[first:last] - table.size[first:last] <= bottom
+    return first + np.flatnonzero(inside)
+
+
+# Lay out lines [start, stop) in chunks, yielding (first index, layouts)
+# so long documents can be laid out a piece at a time
+# after_code is the code context line start is in
+def iter_chunks(
+        style,
+        text_lines,
+        start=0,
+        stop=None,
+        chunk=256,
+        wrap_width=None,
+        after_code=False):
+    if stop is None:
+        stop = len(text_lines)
+    for first in range(start, stop, chunk):
+        last = min(first + chunk, stop)
+        layouts = []
+        for index in range(first, last):
+            line = text_lines[index]
+            layouts.append(layout_line(style, line, after_code, wrap_width))
+            after_code = code_after(line, after_code)
+        yield first, layouts
+
+
+# Height of a plain line of text, used for lines not laid out yet
+def estimate_height(base_size):
+    return base_size + base_size / 3
@@ -0,0 +1,310 @@
+import re
+from collections import namedtuple
+from . Memo import LRU
+
+
+# Markdown tokenizer: every line is split in a single pass into
+# its block (heading, list item, quote...) and a flat stream of
+# typed inline tokens, by precompiled patterns only. It knows nothing
+# about fonts or drawing.
+
+# Block kinds
+PARAGRAPH = 'paragraph'
+HEADING = 'heading'
+BULLET = 'bullet'
+ORDERED = 'ordered'
+QUOTE = 'quote'
+CODE_LINE = 'code_line'
+
+# Inline token kinds
+TEXT_SPAN = 'text'
+CODE_SPAN = 'code'
+LINK_SPAN = 'link'
+IMAGE_SPAN = 'image'
+
+# Emphasis of the text a token is in
+PLAIN = 0
+EMPHASIS = 1
+STRONG = 2
+
+Block = namedtuple('Block', [
+    'kind',    # PARAGRAPH, HEADING, BULLET, ORDERED, QUOTE or CODE_LINE
+    'level',   # 1 to 6 for headings, nesting depth of list items
+    'marker',  # number of an ordered item, '' otherwise
+    'tokens',  # tuple of Token, the text after the block's marker
+])
+
+Token = namedtuple('Token', [
+    'kind',      # TEXT_SPAN, CODE_SPAN, LINK_SPAN or IMAGE_SPAN
+    'text',      # text shown, the alt text of an image
+    'url',       # target of a link or image, '' otherwise
+    'emphasis',  # PLAIN, EMPHASIS or STRONG
+])
+
+# Marker at the start of a line, every alternative is tried at once
+# List items are nested by 2 spaces of indent
+BLOCK_REGEX = re.compile(r'''
+    (?P<heading>\#+)[ \t]*
+  | >[ ]?
+  | (?P<indent>[ \t]*)
+    (?:
+        (?P<bullet>[-+*])
+      | (?P<number>\d{1,9})[.)]
+    )
+    (?:[ \t]+|$)
+''', re.VERBOSE)
+
+# Any character that can start a block marker
+BLOCK_STARTS = '#> \t-+*0123456789'
+
+# Text emphasis is taken around at once, from a character that isn't
+# a space to one that isn't, with no markup in between
+# It is taken in a lookahead and matched again by reference, so it
+# isn't given back one character at a time when no closing run
+# follows, as Python 3.7 has no possessive patterns
+PLAIN_TEXT = r'[^\s`\[*_][^`\[*_]*'
+
+# Inline markup, leftmost first: a code span, a whole link or image,
+# emphasis around plain text, or a run of emphasis delimiters by
+# whether it can open emphasis, close it, or both. Like in
+# CommonMark, a code span ends at the next run of as many backticks
+# as it starts with, a run opens when followed by text and closes
+# when following text, '_' never starts or ends inside a word, like
+# in snake_case names, and runs that can do neither are plain text.
+# Emphasis opening after a space can't close anything, so when
+# only plain text follows up to its closing run, the pair is taken
+# at once, like the delimiter stack would pair it.
+# Apart from code spans looking for their closing backticks, every
+# pattern gives up at the first character it can't take, so nothing
+# is scanned twice, and starts with the character itself, checking
+# what's before it after, so the search skips plain text without
+# trying any of them.
+INLINE_REGEX = re.compile(rf'''
+    `(?<!``)(?=(?P<ticks>`*))(?P=ticks)(?P<code>.+?)(?<!`)`(?P=ticks)(?!`)
+  | !\[(?P<alt>[^\[\]]*)\]\((?P<source>[^()]*)\)
+  | \[(?P<name>[^\[\]]*)\]\((?P<url>[^()]*)\)
+  | \*(?<!\S\*)
+    (?=(?P<star_text>{PLAIN_TEXT}))(?P=star_text)(?<!\s)
+    \*(?!\*)
+  | \*\*(?<!\S\*\*)
+    (?=(?P<strong_star_text>{PLAIN_TEXT}))(?P=strong_star_text)(?<!\s)
+    \*\*(?!\*)
+  | _(?<!\S_)
+    (?=(?P<underscore_text>{PLAIN_TEXT}))(?P=underscore_text)(?<!\s)
+    _(?!\w)
+  | __(?<!\S__)
+    (?=(?P<strong_underscore_text>{PLAIN_TEXT}))
+    (?P=strong_underscore_text)(?<!\s)
+    __(?!\w)
+  | \*(?<=[^\s*]\*)(?P<star_both>\**)(?=[^\s*])
+  | \*(?<!\S\*)(?P<star_open>\**)(?=[^\s*])
+  | \*(?<=[^\s*]\*)(?P<star_close>\**)(?!\S)
+  | _(?<=[^\s\w]_)(?P<underscore_both>_*)(?=[^\s\w])
+  | _(?<!\w_)(?P<underscore_open>_*)(?=[^\s_])
+  | _(?<=[^\s_]_)(?P<underscore_close>_*)(?!\w)
+''', re.VERBOSE)
+
+# Emphasis of the text of each kind of emphasis taken at once
+TEXT_EMPHASIS = {
+    'star_text': EMPHASIS,
+    'underscore_text': EMPHASIS,
+    'strong_star_text': STRONG,
+    'strong_underscore_text': STRONG,
+}
+
+
+MAX_PARSED_LINES = 16384
+
+# Parsed lines, shared by every document
+parsed_lines = LRU(MAX_PARSED_LINES)
+# key : value
+# line text : Block
+
+
+# Tuple of the typed tokens of the inline markup of text, in order
+# Emphasis can hold code, links and other emphasis, their
+# tokens carry the strongest emphasis they are inside of
+# The text is read once, from left to right: code spans, links and
+# plain emphasis are taken as they come, other delimiter runs that
+# can open emphasis wait on a stack for a run that closes them, and
+# what's left of any run is plain text once the line ends
+def parse_inline(text):
+    # Most lines have no markup at all, looking for every character
+    # that can start it on its own is quicker than any pattern
+    if (
+        '`' not in text
+        and '[' not in text
+        and '*' not in text
+        and '_' not in text
+    ):
+        return (Token(TEXT_SPAN, text, '', PLAIN),) if text else ()
+
+    tokens = []
+    # Token of every span, delimiter runs are [index, run] lists
+    # that lose the characters they use
+
+    openers = []
+    # runs that can still open, innermost last
+
+    bottom = {'*': 0, '_': 0}
+    # key : value
+    # delimiter : openers below this can't be closed by its runs,
+    # so no run searches the same openers twice
+
+    pairs = []
+    # (first token, stop token, characters used) of every pair of runs
+
+    # Whether there were delimiter runs, and so emphasis to resolve
+    stacked = False
+
+    position = 0
+    match = INLINE_REGEX.search(text)
+    while match is not None:
+        start = match.start()
+        if position < start:
+            tokens.append(Token(TEXT_SPAN, text[position:start], '', PLAIN))
+        position = match.end()
+
+        # The group closed last tells which markup matched
+        group = match.lastgroup
+        if group in TEXT_EMPHASIS:
+            emphasis = TEXT_EMPHASIS[group]
+            tokens.append(Token(TEXT_SPAN, match.group(group), '', emphasis))
+        elif group == 'code':
+            tokens.append(Token(CODE_SPAN, match.group(group), '', PLAIN))
+        elif group == 'url':
+            name = match.group('name')
+            tokens.append(Token(LINK_SPAN, name, match.group(group), PLAIN))
+        elif group == 'source':
+            name = match.group('alt')
+            tokens.append(Token(IMAGE_SPAN, name, match.group(group), PLAIN))
+        else:
+            stacked = True
+            stack_run(tokens, openers, bottom, pairs, match.group(), group)
+        match = INLINE_REGEX.search(text, position)
+    if position < len(text):
+        tokens.append(Token(TEXT_SPAN, text[position:], '', PLAIN))
+    if not stacked:
+        return tuple(tokens)
+    return resolve_runs(tokens, pairs)
+
+
+# Pair a delimiter run with the innermost runs before it that it can
+# close, then leave what's left of it on the stack if it can open
+# group tells which it can do, as named in INLINE_REGEX
+def stack_run(tokens, openers, bottom, pairs, run, group):
+    char = run[0]
+    closer = [len(tokens), run]
+    tokens.append(closer)
+    if openers and not group.endswith('open'):
+        stack = len(openers) - 1
+        while run and stack >= bottom[char]:
+            opener = openers[stack]
+            if opener[1][0] != char:
+                stack -= 1
+                continue
+            # Two characters from each side make it strong
+            used = 2 if len(run) > 1 and len(opener[1]) > 1 else 1
+            pairs.append((opener[0] + 1, closer[0], used))
+            opener[1] = opener[1][used:]
+            run = run[used:]
+            # Runs in between can no longer open anything
+            del openers[stack + 1:]
+            if not opener[1]:
+                del openers[stack]
+            stack = len(openers) - 1
+        if run:
+            bottom[char] = len(openers)
+        for key in bottom:
+            if bottom[key] > len(openers):
+                bottom[key] = len(openers)
+        closer[1] = run
+    if run and not group.endswith('close'):
+        openers.append(closer)
+
+
+# Tokens with the emphasis of the pairs of runs around them,
+# what's left of the runs joins the text next to it
+def resolve_runs(tokens, pairs):
+    # Every pair counts from the token after its opening run up to
+    # its closing run, a strong one more than all the others together
+    strong = len(pairs) + 1
+    counts = [0] * (len(tokens) + 1)
+    for first, stop, used in pairs:
+        count = strong if used == 2 else 1
+        counts[first] += count
+        counts[stop] -= count
+
+    resolved = []
+    texts = []
+    # text tokens of the same emphasis in a row, joined once they end
+    inside = 0
+    for token, count in zip(tokens, counts):
+        inside += count
+        if type(token) is list:
+            if not token[1]:
+                continue
+            token = Token(TEXT_SPAN, token[1], '', PLAIN)
+        if inside:
+            emphasis = STRONG if inside >= strong else EMPHASIS
+            if token[3] < emphasis:
+                token = Token(token[0], token[1], token[2], emphasis)
+        if texts and (token[0] != TEXT_SPAN or token[3] != texts[0][3]):
+            resolved.append(join_texts(texts))
+            texts = []
+        if token[0] == TEXT_SPAN:
+            texts.append(token)
+        else:
+            resolved.append(token)
+    if texts:
+        resolved.append(join_texts(texts))
+    return tuple(resolved)
+
+
+# One text token for text tokens of the same emphasis in a row
+def join_texts(texts):
+    if len(texts) == 1:
+        return texts[0]
+    text = ''.join(token.text for token in texts)
+    return Token(TEXT_SPAN, text, '', texts[0].emphasis)
+
+
+# Block and inline tokens of one line, memoized
+# Relayouts, e.g. for a new size or width, never parse a line again
+def parse_line(text):
+    block = parsed_lines.get(text)
+    if block is None:
+        block = parsed_lines.put(text, parse_block(text))
+    return block
+
+
+def parse_block(text):
+    # A line starting with a backtick is code as a whole, as before
+    if text.startswith('`'):
+        code = text.replace('`', '')
+        return Block(CODE_LINE, 0, '', (Token(TEXT_SPAN, code, '', PLAIN),))
+
+    # Most lines are paragraphs starting with a letter
+    if text[:1] not in BLOCK_STARTS:
+        return Block(PARAGRAPH, 0, '', parse_inline(text))
+    match = BLOCK_REGEX.match(text)
+    if match is None:
+        return Block(PARAGRAPH, 0, '', parse_inline(text))
+
+    tokens = parse_inline(text[match.end():])
+    # The group closed last tells which marker matched
+    group = match.lastgroup
+    if group == 'heading':
+        level = min(len(match.group(group)), 6)
+        return Block(HEADING, level, '', tokens)
+    if group is None:
+        return Block(QUOTE, 0, '', tokens)
+    level = len(match.group('indent').expandtabs(4)) // 2
+    if group == 'bullet':
+        return Block(BULLET, level, '', tokens)
+    return Block(ORDERED, level, match.group(group), tokens)
+
+
+# Text of tokens without any of their markup
+def plain_text(tokens):
+    return ''.join(token.text for token in tokens)
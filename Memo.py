@@ -0,0 +1,40 @@
+from collections import OrderedDict
+
+
+# Least recently used table of computed values, for the memoized
+# parsing, highlighting and line breaking shared by every layout.
+# Layouts run on the worker thread and the main thread at once, so
+# an entry found by one can be evicted by the other before it is
+# touched; that only costs computing it again, never an error.
+class LRU:
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = OrderedDict()
+        # least recently used first
+
+    def __len__(self):
+        return len(self.entries)
+
+    # The value stored for key, None if there is none
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                pass
+        return value
+
+    # Store value for key, dropping the least recently used entry
+    # once over the limit, and return it
+    def put(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.limit:
+            try:
+                self.entries.popitem(last=False)
+            except KeyError:
+                pass
+        return value
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from functools import lru_cache
+from PIL import ImageFont
+
+
+# Opening a TrueType file is by far the most expensive part of measuring,
+# so every (font path, size) pair is only loaded once per session
+# A font_path of None, no font file found, measures with PIL's default
+@lru_cache(maxsize=64)
+def load_font(font_path, font_size):
+    if font_path is None:
+        try:
+            return ImageFont.load_default(font_size)
+        except TypeError:
+            return ImageFont.load_default()
+    return ImageFont.truetype(font_path, font_size)
+
+
+# Per-font glyph advance, kerning and word tables
+# All tables are LRU caches so very large documents using many
+# distinct characters can't grow them without bound
+class GlyphMetrics:
+    def __init__(
+            self,
+            font_path,
+            font_size,
+            max_glyphs=4096,
+            max_words=16384):
+        self.font = load_font(font_path, font_size)
+        self.max_glyphs = max_glyphs
+        self.max_words = max_words
+
+        self.advances = OrderedDict()
+        # key : value
+        # char : horizontal advance in pixels
+        # 'a' : 9.0
+
+        self.kerning = OrderedDict()
+        # key : value
+        # (left char, right char) : adjustment in pixels
+        # ('A', 'V') : -1.0
+
+        self.words = OrderedDict()
+        # key : value
+        # word : offsets of its characters from its start, plus its width
+        # 'To' : [0.0, 9.5, 19.0]
+
+    def _lookup(self, table, key, compute, limit=None):
+        try:
+            value = table[key]
+            table.move_to_end(key)
+        except KeyError:
+            value = compute()
+            table[key] = value
+            if len(table) > (limit or self.max_glyphs):
+                table.popitem(last=False)
+        return value
+
+    def advance(self, char):
+        return self._lookup(
+            self.advances,
+            char,
+            lambda: self.font.getlength(char)
+        )
+
+    def kern(self, left, right):
+        def compute():
+            pair = self.font.getlength(left + right)
+            return pair - self.advance(left) - self.advance(right)
+        return self._lookup(self.kerning, (left, right), compute)
+
+    # Horizontal offset of every character of a single word,
+    # plus its width as the final entry
+    def word_offsets(self, word):
+        def compute():
+            offsets = []
+            x = 0.0
+            previous = None
+            for char in word:
+                if previous is not None:
+                    x += self.kern(previous, char)
+                offsets.append(x)
+                x += self.advance(char)
+                previous = char
+            offsets.append(x)
+            return offsets
+        return self._lookup(self.words, word, compute, self.max_words)
+
+    # Horizontal offset of every character in the span,
+    # plus the total width as the final entry
+    # Text is measured a word at a time, words repeat so much in
+    # prose that most of them come straight from the word table
+    def offsets(self, text):
+        offsets = []
+        x = 0.0
+        previous = None
+        for index, word in enumerate(text.split(' ')):
+            if index:
+                if previous is not None:
+                    x += self.kern(previous, ' ')
+                offsets.append(x)
+                x += self.advance(' ')
+                previous = ' '
+            if not word:
+                continue
+            if previous is not None:
+                x += self.kern(previous, word[0])
+            word_offsets = self.word_offsets(word)
+            offsets.extend([x + offset for offset in word_offsets[:-1]])
+            x += word_offsets[-1]
+            previous = word[-1]
+        offsets.append(x)
+        return offsets
+
+
+@lru_cache(maxsize=64)
+def get_metrics(font_path, font_size):
+    return GlyphMetrics(font_path, font_size)
+
+
+# Metrics provider for the layout engine
+# Maps font roles ('regular', 'bold', ...) to the font files they use
+class FontMetrics:
+    def __init__(self, font_paths):
+        self.font_paths = dict(font_paths)
+
+    def offsets(self, text, font, font_size):
+        return get_metrics(self.font_paths[font], font_size).offsets(text)
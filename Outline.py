@@ -0,0 +1,182 @@
+from bisect import bisect_left, bisect_right
+from . Layout import heading_level, is_code, is_fence, code_after
+from . Markdown import parse_line, plain_text
+
+
+# Whether line is inside one of the ascending (first, stop) ranges
+def in_ranges(ranges, line):
+    i = bisect_right(ranges, (line, float('inf'))) - 1
+    return i >= 0 and ranges[i][0] <= line < ranges[i][1]
+
+
+# Headings of a document, in order, kept current as lines change
+# A heading's section runs from its line to the next heading of the
+# same or a higher level. Collapsed sections hide everything below
+# their heading, and hidden lines are neither laid out nor drawn.
+# Lines starting with '#' inside fenced code are comments, not headings.
+class Outline:
+    def __init__(self):
+        self.marks = []
+        # line number of every line starting with '#', ascending
+
+        self.mark_levels = []
+        self.mark_titles = []
+        self.mark_collapsed = []
+        # level, title and folding of every mark
+
+        self.fences = []
+        # line number of every line starting with '```', ascending
+        # a line is in fenced code after an odd number of them
+
+        self.lines = []
+        # line number of every heading, ascending
+
+        self.levels = []
+        # 1 to 6, the number of '#' of every heading
+
+        self.titles = []
+        # text of every heading without its markup
+
+        self.collapsed = []
+        # True for every heading whose section is folded
+
+        self.heading_marks = []
+        # index in marks of every heading
+
+        self.hidden = []
+        # (first, stop) line ranges hidden by collapsed sections,
+        # ascending and not overlapping
+
+    def __len__(self):
+        return len(self.lines)
+
+    def scan(self, text_lines, first=0):
+        marks = []
+        fences = []
+        for index, line in enumerate(text_lines, first):
+            if heading_level(line):
+                marks.append(index)
+            elif is_fence(line):
+                fences.append(index)
+        return marks, fences
+
+    # Replace marks [first, last) with the marks at the given lines,
+    # text_lines holds the lines from line offset on
+    def set_marks(self, first, last, marks, text_lines, offset=0):
+        levels = []
+        titles = []
+        for index in marks:
+            line = text_lines[index - offset]
+            levels.append(heading_level(line))
+            titles.append(plain_text(parse_line(line).tokens).strip())
+        self.marks[first:last] = marks
+        self.mark_levels[first:last] = levels
+        self.mark_titles[first:last] = titles
+        self.mark_collapsed[first:last] = [False] * len(marks)
+
+    def rebuild(self, text_lines):
+        # Sections stay folded if their heading is still there
+        folded = {
+            (line, title)
+            for line, title, collapsed
+            in zip(self.lines, self.titles, self.collapsed)
+            if collapsed
+        }
+        lines_starting = getattr(text_lines, 'lines_starting', None)
+        if lines_starting is not None:
+            # Only the lines starting with '#' are decoded
+            marks = lines_starting(b'#')
+            fences = lines_starting(b'```')
+        else:
+            marks, fences = self.scan(text_lines)
+
+        self.set_marks(0, len(self.marks), marks, text_lines)
+        self.mark_collapsed = [
+            (line, title) in folded
+            for line, title in zip(self.marks, self.mark_titles)
+        ]
+        self.fences = fences
+        self.refresh(len(text_lines))
+
+    # Lines [start, stop) were replaced by text_lines
+    # count is the number of lines after the change
+    def replace(self, start, stop, text_lines, count):
+        shift = len(text_lines) - (stop - start)
+        marks, fences = self.scan(text_lines, start)
+
+        first = bisect_left(self.marks, start)
+        last = bisect_left(self.marks, stop)
+        self.set_marks(first, last, marks, text_lines, start)
+        for i in range(first + len(marks), len(self.marks)):
+            self.marks[i] += shift
+
+        first = bisect_left(self.fences, start)
+        last = bisect_left(self.fences, stop)
+        self.fences[first:last] = fences
+        for i in range(first + len(fences), len(self.fences)):
+            self.fences[i] += shift
+        self.refresh(count)
+
+    # Headings are the marks outside of fenced code
+    def refresh(self, count):
+        self.heading_marks = [
+            i for i, line in enumerate(self.marks)
+            if not bisect_left(self.fences, line) % 2
+        ]
+        self.lines = [self.marks[i] for i in self.heading_marks]
+        self.levels = [self.mark_levels[i] for i in self.heading_marks]
+        self.titles = [self.mark_titles[i] for i in self.heading_marks]
+        self.collapsed = [self.mark_collapsed[i] for i in self.heading_marks]
+        self.update_hidden(count)
+
+    # Index of the heading whose section line is in, -1 before the first
+    def find(self, line):
+        return bisect_right(self.lines, line) - 1
+
+    # Lines [first, stop) of the section of heading i
+    def section(self, i, count):
+        level = self.levels[i]
+        for j in range(i + 1, len(self.lines)):
+            if self.levels[j] <= level:
+                return self.lines[i], self.lines[j]
+        return self.lines[i], count
+
+    def toggle(self, i, count):
+        self.collapsed[i] = not self.collapsed[i]
+        self.mark_collapsed[self.heading_marks[i]] = self.collapsed[i]
+        self.update_hidden(count)
+
+    def update_hidden(self, count):
+        hidden = []
+        for i, collapsed in enumerate(self.collapsed):
+            if not collapsed:
+                continue
+            first, stop = self.section(i, count)
+            first += 1
+            if hidden and first <= hidden[-1][1]:
+                # Inside, or right after, a section already folded
+                hidden[-1] = (hidden[-1][0], max(hidden[-1][1], stop))
+            elif first < stop:
+                hidden.append((first, stop))
+        self.hidden = hidden
+
+    def is_hidden(self, line):
+        return in_ranges(self.hidden, line)
+
+    # Code context line index is laid out in, see Layout.code_after
+    # Inside fenced code it is worked out from the opening fence on
+    def code_context(self, text_lines, index):
+        fence = bisect_left(self.fences, index)
+        if not fence % 2:
+            return index > 0 and is_code(text_lines[index - 1])
+        after_code = False
+        for line in text_lines[self.fences[fence - 1]:index]:
+            after_code = code_after(line, after_code)
+        return after_code
+
+    # Headings not inside a folded section, for the table of contents
+    def visible(self):
+        return [
+            i for i, line in enumerate(self.lines)
+            if not self.is_hidden(line)
+        ]
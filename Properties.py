@@ -4,16 +4,70 @@ from bpy.props import FloatProperty
 from bpy.props import IntProperty
 from bpy.props import BoolProperty
 from bpy.props import EnumProperty
+from bpy.props import FloatVectorProperty
+from bpy.props import StringProperty
+from bpy.props import CollectionProperty
 import os
-from . Helpers import update_func
+from . Helpers import update_func, update_size, update_theme
+from . Helpers import update_search, update_texture_budget
+
+
+# A document in the list of open documents, shown as a tab
+class DocViewDocument(PropertyGroup):
+    name: StringProperty()
+
+    path: StringProperty(subtype='FILE_PATH')
 
 
 class DocViewProps(PropertyGroup):
     base_size: IntProperty(
         default=18,
-        update=update_func
+        update=update_size
+    )
+
+    # Most GPU memory, in megabytes, kept for image textures
+    # Least recently drawn images are released first
+    texture_budget: IntProperty(
+        default=256,
+        min=16,
+        update=update_texture_budget
+    )
+
+    # Most memory, in megabytes, kept for laid out documents
+    # that aren't shown, least recently shown are dropped first
+    document_budget: IntProperty(
+        default=128,
+        min=8
+    )
+
+    # Most disk space, in megabytes, kept for layouts saved between
+    # sessions, least recently opened are deleted first
+    store_budget: IntProperty(
+        default=256,
+        min=16
     )
 
+    # Files open as tabs, and the one shown when not using text data
+    documents: CollectionProperty(type=DocViewDocument)
+
+    active_document: IntProperty(default=0)
+
+    # Text datablock shown when using text data, the first one if empty
+    text_name: StringProperty(update=update_func)
+
+    # Draw text from a glyph atlas, in a few batches per frame,
+    # instead of with one blf call per span
+    glyph_atlas: BoolProperty(
+        default=False,
+        update=update_theme
+    )
+
+    # Reload the document when it, or an image it shows, changes on disk
+    watch_files: BoolProperty(default=True)
+
+    # Show how many redraws were issued and skipped in the header
+    show_stats: BoolProperty(default=False)
+
     offset_x: FloatProperty(default=0.0)
 
     offset_y: FloatProperty(default=0.0)
@@ -37,6 +91,11 @@ class DocViewProps(PropertyGroup):
     block = blender_theme.text_editor.line_numbers_background
     text = blender_theme.text_editor.space.text
     link = blender_theme.text_editor.cursor
+    keyword = blender_theme.text_editor.syntax_builtin
+    string = blender_theme.text_editor.syntax_string
+    comment = blender_theme.text_editor.syntax_comment
+    number = blender_theme.text_editor.syntax_numbers
+    special = blender_theme.text_editor.syntax_special
 
     # Dict of Themes
     # Key: theme name
@@ -79,6 +138,50 @@ class DocViewProps(PropertyGroup):
             0.184, 0.506, 0.969, 1],  # link: Blue
     }
 
+    # Dict of code highlighting colors of the themes
+    # Key: theme name
+    # Value: list of 5 RGBA values
+    # Format: Keyword, String, Comment, Number and Special Colors,
+    # special being names of functions, classes and decorators
+    syntax_themes = {
+        'light': [
+            0.5, 0, 0.5, 1,           # keyword: Purple
+            0, 0.4, 0, 1,             # string: Green
+            0.4, 0.4, 0.4, 1,         # comment: Grey
+            0.6, 0.3, 0, 1,           # number: Brown
+            0, 0, 0.6, 1],            # special: Dark Blue
+        'dark': [
+            0.8, 0.5, 0.8, 1,         # keyword: Pink
+            0.5, 0.7, 0.4, 1,         # string: Green
+            0.4, 0.4, 0.4, 1,         # comment: Grey
+            0.8, 0.6, 0.4, 1,         # number: Orange
+            0.4, 0.6, 0.9, 1],        # special: Light Blue
+        'blender': [
+            *keyword, 1,              # keyword: Pink
+            *string, 1,               # string: Green
+            *comment, 1,              # comment: Grey
+            *number, 1,               # number: Blue
+            *special, 1],             # special: Yellow
+        'paperback': [
+            0.5, 0.1, 0.3, 1,         # keyword: Plum
+            0.2, 0.4, 0.1, 1,         # string: Olive
+            0.45, 0.45, 0.4, 1,       # comment: Grey
+            0.6, 0.3, 0, 1,           # number: Brown
+            0, 0, 0.5, 1],            # special: Navy
+        'c64': [
+            0.8, 0.8, 0.8, 1,         # keyword: White
+            0.6, 0.8, 0.4, 1,         # string: Light Green
+            0.4, 0.4, 0.8, 1,         # comment: Purple Blue
+            1, 0.8, 0.4, 1,           # number: Light Orange
+            0.4, 0.8, 1, 1],          # special: Cyan
+        'github': [
+            1, 0.482, 0.447, 1,       # keyword: Red
+            0.647, 0.839, 1, 1,       # string: Light Blue
+            0.545, 0.58, 0.62, 1,     # comment: Grey
+            0.475, 0.753, 1, 1,       # number: Blue
+            0.824, 0.659, 1, 1],      # special: Purple
+    }
+
     current_theme: EnumProperty(
         name='Theme',  # noqa
         items={
@@ -88,7 +191,80 @@ class DocViewProps(PropertyGroup):
             ('paperback', 'Paperback', 'Grey Text on Tan Background', 'HELP', 3),  # noqa
             ('c64', 'C64', 'Light Blue Text on Dark Blue Background', 'RESTRICT_VIEW_OFF', 4),  # noqa
             ('github', 'Github', 'White Text on Dark Blue Grey Background', 'NETWORK_DRIVE', 5),  # noqa
+            ('custom', 'Custom', 'Colors picked below', 'COLOR', 6),  # noqa
         },
         default='light',  # noqa
-        update=update_func
+        update=update_theme
+    )
+
+    # Colors of the 'custom' theme, in the same order as the others
+    custom_bg: FloatVectorProperty(
+        subtype='COLOR', size=4, min=0, max=1,
+        default=(0.8, 0.8, 0.8, 1),
+        update=update_theme
     )
+    custom_block: FloatVectorProperty(
+        subtype='COLOR', size=4, min=0, max=1,
+        default=(0.6, 0.6, 0.6, 1),
+        update=update_theme
+    )
+    custom_text: FloatVectorProperty(
+        subtype='COLOR', size=4, min=0, max=1,
+        default=(0, 0, 0, 1),
+        update=update_theme
+    )
+    custom_link: FloatVectorProperty(
+        subtype='COLOR', size=4, min=0, max=1,
+        default=(0, 0, 1, 1),
+        update=update_theme
+    )
+
+    # File shown when not using text data
+    def document_path(self):
+        if 0 <= self.active_document < len(self.documents):
+            return self.documents[self.active_document].path
+        return self.external_path
+
+    # Color of the words matching the search, in every theme
+    highlight: FloatVectorProperty(
+        subtype='COLOR', size=4, min=0, max=1,
+        default=(1, 0.5, 0, 1),
+        update=update_theme
+    )
+
+    # Words to find in the document, matched as word prefixes
+    search: StringProperty(
+        options={'TEXTEDIT_UPDATE'},
+        update=update_search
+    )
+
+    # RGBA of every color role of the current theme, indexed by
+    # Layout.BACKGROUND, BLOCK, TEXT, LINK and HIGHLIGHT, then
+    # Highlight.KEYWORD, STRING, COMMENT, NUMBER and SPECIAL
+    def palette(self):
+        if self.current_theme == 'custom':
+            # Code is highlighted with the link color,
+            # comments fade halfway into the background
+            text = tuple(self.custom_text)
+            link = tuple(self.custom_link)
+            comment = tuple(
+                (text_value + bg_value) / 2
+                for text_value, bg_value in zip(text, self.custom_bg)
+            )
+            return (
+                tuple(self.custom_bg),
+                tuple(self.custom_block),
+                text,
+                link,
+                tuple(self.highlight),
+                link,
+                text,
+                comment,
+                text,
+                link,
+            )
+        theme = self.themes[self.current_theme]
+        colors = tuple(tuple(theme[i:i + 4]) for i in range(0, 16, 4))
+        syntax = self.syntax_themes[self.current_theme]
+        syntax = tuple(tuple(syntax[i:i + 4]) for i in range(0, 20, 4))
+        return colors + (tuple(self.highlight),) + syntax
@@ -0,0 +1,64 @@
+import bpy
+
+
+# Redraw every Document Viewer area
+def redraw_viewers():
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.ui_type == 'DocumentViewer':
+                area.tag_redraw()
+
+
+# Redraws are only asked for when something the viewers show changed:
+# scroll, area size, content, theme or an image arriving. Requests made
+# within the same frame are coalesced into a single tag_redraw.
+class RedrawScheduler:
+    def __init__(self, interval=1 / 60):
+        self.interval = interval
+        self.pending = False
+
+        self.reasons = set()
+        # what changed since the last redraw, e.g. {'scroll', 'content'}
+
+        # Redraws tagged, and events or requests that didn't need one
+        self.issued = 0
+        self.skipped = 0
+
+    def request(self, reason):
+        self.reasons.add(reason)
+        if self.pending:
+            self.skipped += 1
+            return
+        self.pending = True
+        if not bpy.app.timers.is_registered(flush_redraws):
+            bpy.app.timers.register(
+                flush_redraws,
+                first_interval=self.interval
+            )
+
+    # Nothing changed, no redraw
+    def skip(self):
+        self.skipped += 1
+
+    def flush(self):
+        if self.pending:
+            redraw_viewers()
+            self.issued += 1
+        self.pending = False
+        self.reasons.clear()
+        return None
+
+    def reset(self):
+        if bpy.app.timers.is_registered(flush_redraws):
+            bpy.app.timers.unregister(flush_redraws)
+        self.pending = False
+        self.reasons.clear()
+        self.issued = 0
+        self.skipped = 0
+
+
+redraw = RedrawScheduler()
+
+
+def flush_redraws():
+    return redraw.flush()
@@ -0,0 +1,158 @@
+import re
+from array import array
+from bisect import bisect_left, insort
+import numpy as np
+
+
+TOKEN_REGEX = re.compile(r'\w+')
+
+# Rough memory used by one word of an index, besides its postings:
+# the string, its array and their entries in postings and tokens
+WORD_BYTES = 160
+
+
+def tokenize(text):
+    return TOKEN_REGEX.findall(text.lower())
+
+
+# Inverted index of the words of a document's lines
+# Every line gets an id that doesn't change when lines are inserted
+# or removed above it, so an edit only touches the postings of the
+# lines it changed; ids are mapped back to line numbers per query
+# Only the postings are kept, the words of a line that goes away are
+# found by reading it again, and the ids are packed in arrays
+class SearchIndex:
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=np.int64)
+        # id of every line, in document order
+
+        self.postings = {}
+        # key : value
+        # word : array of the ids of the lines containing it, ascending
+
+        self.tokens = []
+        # every word in postings, sorted, for prefix lookups
+
+        self.next_id = 0
+
+    # Give text_lines the next ids and add them to the postings
+    # Returns their ids, and the words that weren't indexed before
+    def add_lines(self, text_lines):
+        first = self.next_id
+        words = []
+        for line_id, line in enumerate(text_lines, first):
+            for word in set(tokenize(line)):
+                posting = self.postings.get(word)
+                if posting is None:
+                    posting = self.postings[word] = array('i')
+                    words.append(word)
+                posting.append(line_id)
+            self.next_id = line_id + 1
+        return np.arange(first, self.next_id, dtype=np.int64), words
+
+    # Take the lines with line_ids, whose text was text_lines,
+    # out of the postings
+    def remove_lines(self, line_ids, text_lines):
+        for line_id, line in zip(line_ids, text_lines):
+            for word in set(tokenize(line)):
+                posting = self.postings[word]
+                del posting[bisect_left(posting, line_id)]
+                if not posting:
+                    del self.postings[word]
+                    del self.tokens[bisect_left(self.tokens, word)]
+
+    def rebuild(self, text_lines):
+        self.postings.clear()
+        self.next_id = 0
+        self.ids, words = self.add_lines(text_lines)
+        self.tokens = sorted(words)
+
+    # Lines [start, stop), old_lines, were replaced by text_lines
+    # Only words new to the index, or gone from it, move in tokens
+    def replace(self, start, stop, old_lines, text_lines):
+        added, words = self.add_lines(text_lines)
+        for word in words:
+            insort(self.tokens, word)
+        self.remove_lines(self.ids[start:stop].tolist(), old_lines)
+        self.ids = np.concatenate((self.ids[:start], added, self.ids[stop:]))
+
+    # Rough bytes used, counted in the document cache budget
+    def size(self):
+        ids = sum(len(posting) for posting in self.postings.values())
+        return (
+            self.ids.nbytes
+            + ids * array('i').itemsize
+            + len(self.postings) * WORD_BYTES
+        )
+
+    # Ids, ascending, of the lines with a word starting with prefix
+    def prefix_ids(self, prefix):
+        found = []
+        index = bisect_left(self.tokens, prefix)
+        while index < len(self.tokens):
+            word = self.tokens[index]
+            if not word.startswith(prefix):
+                break
+            found.append(np.frombuffer(self.postings[word], dtype=np.intc))
+            index += 1
+        if not found:
+            return np.zeros(0, dtype=np.intc)
+        return np.unique(np.concatenate(found))
+
+    # Line numbers, ascending, of the lines with a word starting
+    # with every word of the query
+    def search(self, query):
+        terms = tokenize(query)
+        if not terms:
+            return np.zeros(0, dtype=np.int64)
+        found = None
+        for term in sorted(terms, key=len, reverse=True):
+            ids = self.prefix_ids(term)
+            if found is None:
+                found = ids
+            else:
+                found = np.intersect1d(found, ids, assume_unique=True)
+            if not len(found):
+                return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(np.isin(self.ids, found))
+
+
+# Pattern matching the words a query highlights, or None
+def highlight_pattern(query):
+    terms = tokenize(query)
+    if not terms:
+        return None
+    alternatives = '|'.join(re.escape(term) for term in terms)
+    return re.compile(rf'\b(?:{alternatives})\w*', re.IGNORECASE)
+
+
+# The query shown in the viewers, and its matches in the shown document
+# Matches are searched again whenever the document changes, or until
+# its lines are indexed
+class SearchState:
+    def __init__(self):
+        self.query = ''
+        self.pattern = None
+        self.matches = None
+        self.version = None
+        # (document, generation) the matches were found in
+
+    def set_query(self, query):
+        self.query = query.strip()
+        self.pattern = highlight_pattern(self.query)
+        self.matches = None
+        self.version = None
+
+    # Ascending line numbers of the matches, None when not searching
+    def find(self, document):
+        if self.pattern is None:
+            return None
+        version = (document, document.generation)
+        if self.version != version:
+            self.matches = document.search(self.query)
+            if self.matches is not None:
+                self.version = version
+        return self.matches
+
+
+search_state = SearchState()
@@ -0,0 +1,213 @@
+import hashlib
+import os
+import threading
+from array import array
+import numpy as np
+
+
+# Bytes scanned at a time when indexing, keeps the scan's own
+# memory small next to the file
+SCAN_BYTES = 16 * 1024 * 1024
+
+# Lines read at a time when going through all of them
+READ_LINES = 4096
+
+# On-disk index format version, bump when the layout below changes
+INDEX_VERSION = 1
+
+
+# The lines of a text file, read from it as they are asked for
+# Only the start offset of every line is kept in memory, in a
+# compact array; a line is read and decoded when layout or draw asks
+# for it. The file isn't mapped, a file cut short while it is shown
+# only reads as shorter lines, and editors can still save over it.
+class LineFile:
+    def __init__(self, path, offsets, stat_key):
+        self.path = path
+        self.offsets = offsets
+        self.stat_key = stat_key
+        self.size = stat_key[2]
+        self.file = open(path, 'rb') if self.size else None
+
+        # Seeking and reading is one step for the threads sharing
+        # the file, where os.pread is missing, e.g. on Windows
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self.read_lines(start, stop)
+            return [self[i] for i in range(start, stop, step)]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('line index out of range')
+        return self.read_lines(index, index + 1)[0]
+
+    def __iter__(self):
+        for start in range(0, len(self), READ_LINES):
+            yield from self.read_lines(start, start + READ_LINES)
+
+    # Bytes [start, end) of the file, fewer if it got shorter
+    def read(self, start, end):
+        file = self.file
+        if file is None or end <= start:
+            return b''
+        try:
+            if hasattr(os, 'pread'):
+                return os.pread(file.fileno(), end - start, start)
+            with self.lock:
+                file.seek(start)
+                return file.read(end - start)
+        # Closed in the meantime, e.g. by another thread
+        except (OSError, ValueError):
+            return b''
+
+    # The file from start to end, SCAN_BYTES at a time
+    def blocks(self):
+        for start in range(0, self.size, SCAN_BYTES):
+            block = self.read(start, min(start + SCAN_BYTES, self.size))
+            if block:
+                yield block
+
+    # Lines [start, stop), read from the file at once
+    def read_lines(self, start, stop):
+        stop = min(stop, len(self))
+        if start >= stop:
+            return []
+        if stop < len(self.offsets):
+            end = self.offsets[stop] - 1
+        else:
+            end = self.size
+        data = self.read(self.offsets[start], end)
+        lines = data.decode('utf-8', errors='replace').split('\n')
+        # Same lines as reading in text mode and splitting on '\n'
+        lines = [
+            line[:-1] if line.endswith('\r') else line
+            for line in lines
+        ]
+        # A file cut short since it was indexed has fewer lines
+        lines += [''] * (stop - start - len(lines))
+        return lines[:stop - start]
+
+    # Numbers of the lines starting with prefix, found without
+    # decoding any line, so e.g. the headings of huge files are
+    # listed in one pass
+    def lines_starting(self, prefix):
+        starts = np.frombuffer(self.offsets, dtype=self.offsets.typecode)
+        found = []
+        for block_start in range(0, self.size, SCAN_BYTES):
+            block_end = block_start + SCAN_BYTES
+            first, stop = np.searchsorted(starts, (block_start, block_end))
+            if first == stop:
+                continue
+            # A line starting near the end can go on past the block
+            data = np.frombuffer(
+                self.read(block_start, block_end + len(prefix)),
+                dtype=np.uint8
+            )
+            local = starts[first:stop].astype(np.int64) - block_start
+            matches = np.ones(len(local), dtype=bool)
+            for i, byte in enumerate(prefix):
+                inside = local + i < len(data)
+                matches &= inside
+                matches[inside] &= data[local[inside] + i] == byte
+            found.append(np.flatnonzero(matches) + first)
+        if not found:
+            return []
+        return np.concatenate(found).tolist()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# Start offset of every line, found with numpy a block at a time
+def scan_offsets(path, size):
+    typecode = 'I' if size < 2 ** 32 else 'Q'
+    offsets = array(typecode, [0])
+    if not size:
+        return offsets
+    with open(path, 'rb') as file:
+        start = 0
+        while start < size:
+            block = file.read(min(SCAN_BYTES, size - start))
+            if not block:
+                break
+            data = np.frombuffer(block, dtype=np.uint8)
+            newlines = np.flatnonzero(data == 10) + (start + 1)
+            offsets.frombytes(newlines.astype(typecode).tobytes())
+            start += len(block)
+    return offsets
+
+
+def index_path(cache_dir, path):
+    name = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f'{name}.idx')
+
+
+# Index file: a header line naming the file version it was built
+# from, followed by the raw offsets array
+def read_index(cache_dir, path, stat_key):
+    if cache_dir is None:
+        return None
+    try:
+        with open(index_path(cache_dir, path), 'rb') as file:
+            header = file.readline().decode('utf-8').split()
+            if header[:3] != [str(INDEX_VERSION), *map(str, stat_key[1:])]:
+                return None
+            offsets = array(header[3])
+            offsets.frombytes(file.read())
+            return offsets
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def write_index(cache_dir, path, stat_key, offsets):
+    if cache_dir is None:
+        return
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        target = index_path(cache_dir, path)
+        partial = f'{target}.partial'
+        with open(partial, 'wb') as file:
+            header = f'{INDEX_VERSION} {stat_key[1]} {stat_key[2]} '
+            file.write(f'{header}{offsets.typecode}\n'.encode('utf-8'))
+            offsets.tofile(file)
+        os.replace(partial, target)
+    except OSError as error:
+        print(f'Could not save line index: {error}')
+
+
+# Line indexes of files opened this session
+indexes = {}
+# key : value
+# (path, mtime, size) : offsets array
+
+
+# Open a text file as a sequence of lines
+# The line index is reused from this session, or from cache_dir
+# when the file hasn't changed since it was last indexed
+def open_lines(path, cache_dir=None):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stat_key = (path, stat.st_mtime_ns, stat.st_size)
+
+    offsets = indexes.get(stat_key)
+    if offsets is None:
+        offsets = read_index(cache_dir, path, stat_key)
+    if offsets is None:
+        offsets = scan_offsets(path, stat.st_size)
+        write_index(cache_dir, path, stat_key, offsets)
+
+    # Older versions of the same file are no use anymore
+    for key in [key for key in indexes if key[0] == path]:
+        del indexes[key]
+    indexes[stat_key] = offsets
+
+    return LineFile(path, offsets, stat_key)
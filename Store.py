@@ -0,0 +1,287 @@
+import copy
+import gc
+import hashlib
+import os
+import pickle
+import threading
+import weakref
+from collections import namedtuple
+from . Document import VirtualDocument
+from . Images import image_cache
+from . Tabs import image_keys
+
+
+# On-disk format version, bump when the layouts or StoredLayout change
+STORE_VERSION = 1
+
+# Extension of the files holding saved layouts in the cache folder
+STORE_EXTENSION = '.layout'
+
+StoredLayout = namedtuple('StoredLayout', [
+    'kind',      # name of the document class, Document or VirtualDocument
+    'viewport',  # (width, height) the lines were wrapped for
+    'outline',   # Outline of the document, with its folded sections
+    'images',    # (key, path, mtime, size) of every image shown
+    'display',   # Document: its whole DisplayList, None otherwise
+    'chunks',    # VirtualDocument: ((first line, tuple of LineLayout), ...)
+    'heights',   # VirtualDocument: deltas of its HeightIndex, as bytes
+])
+
+
+# Hash of the text of a file opened with Source.open_lines,
+# read a block at a time
+def content_digest(text_lines):
+    digest = hashlib.sha1()
+    for block in text_lines.blocks():
+        digest.update(block)
+    return digest.hexdigest()
+
+
+# Path, modification time and size of a file, None if it is missing
+def file_key(path):
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+# Layouts of documents saved to disk, so opening a long document again,
+# even in a later session, reads its display list instead of laying
+# it out. Entries are named after everything a layout depends on: the
+# text, the font files, the base size and the format version. The area
+# width isn't part of it, saved lines are wrapped again when loaded,
+# like after any resize, and only the ones that break differently
+# are laid out. The least recently opened entries are deleted once
+# the folder goes over budget.
+class LayoutStore:
+    def __init__(self, budget=256 * 1024 * 1024):
+        # Most bytes of saved layouts kept in folder
+        self.budget = budget
+        self.folder = None
+
+        self.digests = {}
+        # key : value
+        # (path, mtime, size) : content digest of the file
+
+        self.tracked = weakref.WeakKeyDictionary()
+        # key : value
+        # document : (entry name, generation it describes,
+        #             display list last saved or loaded)
+
+        # Entries loaded, documents laid out for lack of one,
+        # and entries saved and deleted
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+        self.evictions = 0
+
+        # Only one entry is written at a time
+        self.lock = threading.Lock()
+
+    # Name of the entry for text_lines laid out with style,
+    # None when it can't be saved, e.g. for Blender texts
+    def key(self, text_lines, style):
+        stat_key = getattr(text_lines, 'stat_key', None)
+        if stat_key is None:
+            return None
+        if stat_key not in self.digests:
+            self.digests[stat_key] = content_digest(text_lines)
+
+        parts = [
+            str(STORE_VERSION),
+            self.digests[stat_key],
+            repr(style.base_size)
+        ]
+        font_paths = getattr(style.metrics, 'font_paths', {})
+        for role in sorted(font_paths):
+            parts.append(f'{role}={file_key(font_paths[role])}')
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def path(self, name):
+        return os.path.join(self.folder, f'{name}{STORE_EXTENSION}')
+
+    # Show document from its saved entry
+    # Returns False, leaving document alone, if there is none
+    # or it no longer holds, e.g. an image it shows changed
+    def load(self, document, name, text_lines, viewport):
+        if name is None or self.folder is None:
+            return False
+        entry = self.read(name)
+        if (
+            entry is None
+            or entry.kind != type(document).__name__
+            or not restore_images(entry.images)
+        ):
+            self.misses += 1
+            return False
+
+        if isinstance(document, VirtualDocument):
+            document.restore(
+                text_lines,
+                entry.chunks,
+                entry.heights,
+                entry.outline,
+                entry.viewport,
+                viewport
+            )
+        else:
+            document.restore(entry.display, entry.outline, viewport)
+        self.tracked[document] = (name, document.generation, document.display)
+        self.hits += 1
+        return True
+
+    def read(self, name):
+        path = self.path(name)
+        try:
+            with open(path, 'rb') as file:
+                header = file.readline().decode('utf-8').split()
+                if header != [str(STORE_VERSION), name]:
+                    return None
+                # Millions of small tuples are made at once,
+                # collecting in between would only slow it down
+                gc.disable()
+                try:
+                    entry = pickle.load(file)
+                finally:
+                    gc.enable()
+            # Touched, so it is evicted last
+            os.utime(path)
+        # A damaged or foreign file is treated as no entry at all
+        except Exception:
+            return None
+        if not isinstance(entry, StoredLayout):
+            return None
+        return entry
+
+    # From now on document is saved under name, as long as it
+    # describes the same text as it does now
+    def track(self, document, name):
+        if name is None:
+            self.tracked.pop(document, None)
+            return
+        tracked = self.tracked.get(document)
+        if tracked is None or tracked[:2] != (name, document.generation):
+            self.tracked[document] = (name, document.generation, None)
+
+    # Save document to its entry, on a worker thread
+    # Nothing is saved while it is still being laid out, or if it
+    # changed since it was tracked, or was already saved like this
+    def save(self, document):
+        tracked = self.tracked.get(document)
+        if tracked is None or self.folder is None:
+            return False
+        name, generation, saved = tracked
+        if (
+            document.generation != generation
+            or document.display is None
+            or document.display is saved
+            or not document.complete()
+        ):
+            return False
+
+        images = []
+        for key in image_keys(document):
+            source = image_cache.sources.get(key)
+            stat_key = file_key(source[0]) if source is not None else None
+            if stat_key is None:
+                return False
+            images.append((key, *stat_key))
+
+        # Layouts are immutable tuples, everything else is copied
+        # here so the document can change while it is written
+        if isinstance(document, VirtualDocument):
+            entry = StoredLayout(
+                type(document).__name__,
+                document.viewport,
+                copy.deepcopy(document.outline),
+                tuple(images),
+                None,
+                tuple(
+                    (first, tuple(layouts))
+                    for first, layouts in document.chunks.items()
+                ),
+                document.heights.deltas.tobytes()
+            )
+        else:
+            entry = StoredLayout(
+                type(document).__name__,
+                document.viewport,
+                copy.deepcopy(document.outline),
+                tuple(images),
+                document.display,
+                None,
+                None
+            )
+        self.tracked[document] = (name, generation, document.display)
+
+        thread = threading.Thread(
+            target=self.write,
+            args=(self.folder, name, entry),
+            name='docview_store',
+            daemon=True
+        )
+        thread.start()
+        return True
+
+    # Runs on a worker thread
+    def write(self, folder, name, entry):
+        with self.lock:
+            target = os.path.join(folder, f'{name}{STORE_EXTENSION}')
+            partial = f'{target}.partial'
+            try:
+                os.makedirs(folder, exist_ok=True)
+                with open(partial, 'wb') as file:
+                    file.write(f'{STORE_VERSION} {name}\n'.encode('utf-8'))
+                    pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(partial, target)
+                self.saves += 1
+                self.evict(folder, keep=target)
+            except Exception as error:
+                print(f'Could not save layout: {error}')
+
+    # Delete least recently opened entries until under budget
+    def evict(self, folder, keep=None):
+        entries = []
+        for item in os.scandir(folder):
+            if item.name.endswith(STORE_EXTENSION):
+                stat = item.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, item.path))
+        entries.sort()
+        used = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if used <= self.budget:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            used -= size
+            self.evictions += 1
+
+    def reset(self):
+        self.digests.clear()
+        self.tracked.clear()
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+        self.evictions = 0
+
+
+layout_store = LayoutStore()
+
+
+# Make the images a saved entry shows loadable under the same keys
+# The files are only hashed again if they changed, in which case
+# the entry is of no use
+def restore_images(images):
+    for key, path, mtime, size in images:
+        if file_key(path) != (path, mtime, size):
+            return False
+        image_cache.digests.setdefault((path, mtime, size), key)
+        loaded = image_cache.load(path)
+        if loaded is None or loaded[0] != key:
+            return False
+    return True
@@ -0,0 +1,149 @@
+import os
+from collections import namedtuple, OrderedDict
+from . Document import VirtualDocument
+from . Images import image_cache
+
+
+# Rough memory used by one laid out line: its namedtuples, spans and tops
+LAYOUT_BYTES = 1024
+
+CachedDocument = namedtuple('CachedDocument', [
+    'document',  # Document or VirtualDocument
+    'images',    # image loader the document was laid out with
+    'stamp',     # version of the source it was made from, None if unknown
+    'scroll',    # (x, y) view scroll the document was left at, or None
+    'size',      # estimated bytes used by the document
+])
+
+
+# Key of a document in the cache
+# Files are keyed by path, Blender texts by name
+def document_key(internal, name):
+    if internal:
+        return ('text', name)
+    return ('file', os.path.abspath(name))
+
+
+def document_size(document):
+    # The search index of a document searched in counts as well
+    index = document.index.size() if document.index is not None else 0
+    if isinstance(document, VirtualDocument):
+        # The lines stay in the file, only laid out chunks count
+        lines = sum(len(layouts) for layouts in document.chunks.values())
+        return lines * LAYOUT_BYTES + index
+    characters = sum(len(line) for line in document.source)
+    return len(document.layouts) * LAYOUT_BYTES + characters + index
+
+
+def image_keys(document):
+    if isinstance(document, VirtualDocument):
+        layouts = [
+            layout
+            for layouts in document.chunks.values()
+            for layout in layouts
+        ]
+    else:
+        layouts = document.layouts
+    return {image.key for layout in layouts for image in layout.images}
+
+
+# Every document opened this session, with its layout and scroll
+# Switching back to a cached document reuses all of it; the least
+# recently shown ones are dropped once the cache goes over budget
+class DocumentCache:
+    def __init__(self, budget=128 * 1024 * 1024):
+        self.budget = budget
+        self.used = 0
+
+        self.entries = OrderedDict()
+        # key : value
+        # document_key : CachedDocument
+        # least recently shown first
+
+        # Documents shown from the cache, read again for lack of an
+        # up to date one, and dropped from it
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, stamp=None):
+        entry = self.entries.get(key)
+        if stamp is not None:
+            if entry is not None and entry.stamp == stamp:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, document, images, stamp=None):
+        previous = self.entries.pop(key, None)
+        scroll = None
+        if previous is not None:
+            self.used -= previous.size
+            scroll = previous.scroll
+        size = document_size(document)
+        self.entries[key] = CachedDocument(
+            document,
+            images,
+            stamp,
+            scroll,
+            size
+        )
+        self.used += size
+        self.evict(keep=key)
+
+    # Count the size of a cached document again, e.g. once it was
+    # indexed for a search
+    def resize(self, document):
+        for key, entry in self.entries.items():
+            if entry.document is document:
+                size = document_size(document)
+                self.used += size - entry.size
+                self.entries[key] = entry._replace(size=size)
+                self.evict(keep=key)
+                return
+
+    def save_scroll(self, key, scroll):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries[key] = entry._replace(scroll=scroll)
+
+    # Drop least recently shown documents until under budget,
+    # giving back the textures only they were using
+    def evict(self, keep=None):
+        for key in list(self.entries):
+            if self.used <= self.budget:
+                break
+            if key != keep:
+                self.forget(key)
+                self.evictions += 1
+
+    def forget(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.used -= entry.size
+
+        in_use = set()
+        for other in self.entries.values():
+            in_use |= image_keys(other.document)
+        for image in image_keys(entry.document) - in_use:
+            image_cache.release(image)
+
+        close = getattr(entry.document.source, 'close', None)
+        if close is not None:
+            close()
+
+    def clear(self):
+        for key in list(self.entries):
+            self.forget(key)
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+document_cache = DocumentCache()
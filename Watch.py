@@ -0,0 +1,113 @@
+import bpy
+import os
+import time
+
+
+# Seconds between polls, and most files stat'ed by one poll
+# A poll never costs more than budget stat calls however many
+# files are watched, larger sets are checked over several polls
+POLL_INTERVAL = 0.5
+POLL_BUDGET = 32
+
+
+# Version of a file on disk, a changed stamp means reading it again
+# None if the file is missing
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+# Watches the shown document and the images it links to for changes
+# by polling os.stat from a timer, a few files at a time
+class FileWatcher:
+    def __init__(self, interval=POLL_INTERVAL, budget=POLL_BUDGET):
+        self.interval = interval
+        self.budget = budget
+        self.on_change = None
+
+        self.files = {}
+        # key : value
+        # path : stamp when last checked, None if missing
+
+        self.order = []
+        # watched paths, polled round robin from cursor
+        self.cursor = 0
+
+        # Polls run, stat calls made, seconds spent polling
+        # and changes found since the add-on was registered
+        self.polls = 0
+        self.stats = 0
+        self.poll_time = 0.0
+        self.changes = 0
+
+    # Watch exactly these paths, calling on_change(changed paths)
+    # when any of them is modified, created or deleted
+    def watch(self, paths, on_change):
+        paths = list(dict.fromkeys(os.path.abspath(path) for path in paths))
+        files = {}
+        for path in paths:
+            stamp = self.files.get(path)
+            if stamp is None:
+                stamp = file_stamp(path)
+                self.stats += 1
+            files[path] = stamp
+        self.files = files
+        self.order = paths
+        self.cursor = 0
+        self.on_change = on_change
+        if paths and not bpy.app.timers.is_registered(poll_files):
+            bpy.app.timers.register(
+                poll_files,
+                first_interval=self.interval,
+                persistent=True
+            )
+
+    def poll(self):
+        if not self.order:
+            return None
+        start = time.perf_counter()
+
+        count = min(self.budget, len(self.order))
+        changed = []
+        for _ in range(count):
+            path = self.order[self.cursor]
+            self.cursor = (self.cursor + 1) % len(self.order)
+            stamp = file_stamp(path)
+            if stamp != self.files[path]:
+                self.files[path] = stamp
+                changed.append(path)
+
+        self.polls += 1
+        self.stats += count
+        self.poll_time += time.perf_counter() - start
+
+        if changed:
+            self.changes += len(changed)
+            if self.on_change is not None:
+                self.on_change(changed)
+        return self.interval
+
+    def stop(self):
+        if bpy.app.timers.is_registered(poll_files):
+            bpy.app.timers.unregister(poll_files)
+        self.files = {}
+        self.order = []
+        self.cursor = 0
+        self.on_change = None
+
+    def reset(self):
+        self.stop()
+        self.polls = 0
+        self.stats = 0
+        self.poll_time = 0.0
+        self.changes = 0
+
+
+watcher = FileWatcher()
+
+
+def poll_files():
+    return watcher.poll()
@@ -0,0 +1,217 @@
+import bpy
+import queue
+import threading
+import time
+from . Layout import iter_chunks
+from . Redraw import redraw
+from . Search import SearchIndex
+from . Store import layout_store
+from . Tabs import document_cache
+
+
+# Lines laid out by the worker between two hand-overs
+CHUNK = 512
+
+# Seconds between checks for finished chunks on the main thread
+COLLECT_INTERVAL = 0.05
+
+
+# Lays out all the lines of a Document on a worker thread
+# Chunks are queued as they are finished and appended to the document
+# from a timer on the main thread, so the top of the document is
+# drawn while the rest is still being laid out
+class LayoutJob:
+    def __init__(self, document, text_lines, style, viewport):
+        self.generation = document.begin(text_lines, style, viewport)
+        self.document = document
+        self.lines = document.source
+        self.style = document.style
+        self.wrap_width = document.viewport[0]
+
+        self.results = queue.SimpleQueue()
+        # lists of LineLayout in document order, then None when done
+
+        self.cancelled = threading.Event()
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='docview_layout',
+            daemon=True
+        )
+
+    def run(self):
+        try:
+            chunks = iter_chunks(
+                self.style,
+                self.lines,
+                0,
+                len(self.lines),
+                CHUNK,
+                self.wrap_width
+            )
+            for first, layouts in chunks:
+                if self.cancelled.is_set():
+                    return
+                self.results.put(layouts)
+        except Exception as error:
+            self.results.put(error)
+        self.results.put(None)
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+# Builds the search index of a long document for its first search,
+# so the whole file is read on the worker instead of while drawing
+class IndexJob:
+    def __init__(self, document):
+        self.generation = document.generation
+        self.document = document
+        self.lines = document.source
+
+        self.results = queue.SimpleQueue()
+        # the SearchIndex, then None when done
+
+        self.cancelled = threading.Event()
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='docview_index',
+            daemon=True
+        )
+
+    def run(self):
+        try:
+            index = SearchIndex()
+            index.rebuild(self.pending_lines())
+            if not self.cancelled.is_set():
+                self.results.put(index)
+        except Exception as error:
+            self.results.put(error)
+        self.results.put(None)
+
+    # The lines, cut short once the job is cancelled
+    def pending_lines(self):
+        for line in self.lines:
+            if self.cancelled.is_set():
+                return
+            yield line
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+# The one background job running at a time
+# Starting a new one cancels the previous, and the document itself
+# refuses chunks and indexes made for an older version of it
+class LayoutWorker:
+    def __init__(self):
+        self.job = None
+
+        # Jobs started, finished and cancelled, and the time
+        # the last finished job took
+        self.started = 0
+        self.finished = 0
+        self.cancelled = 0
+        self.last_time = 0.0
+
+    def start(self, document, text_lines, style=None, viewport=None):
+        self.run(LayoutJob(document, text_lines, style, viewport))
+
+    # Build the search index of document, for its first search
+    def index(self, document):
+        self.run(IndexJob(document))
+
+    def run(self, job):
+        self.cancel()
+        self.job = job
+        self.job.thread.start()
+        self.started += 1
+        if not bpy.app.timers.is_registered(collect_layouts):
+            bpy.app.timers.register(
+                collect_layouts,
+                first_interval=COLLECT_INTERVAL
+            )
+
+    # True while a job is working on document
+    def busy(self, document):
+        return self.job is not None and self.job.document is document
+
+    # Stop the running job, or only if it lays out document
+    def cancel(self, document=None):
+        job = self.job
+        if job is None:
+            return
+        if document is not None and job.document is not document:
+            return
+        job.cancel()
+        self.job = None
+        self.cancelled += 1
+
+    # Timer on the main thread: append every chunk finished so far
+    def collect(self):
+        job = self.job
+        if job is None:
+            return None
+
+        layouts = []
+        index = None
+        done = False
+        while True:
+            try:
+                item = job.results.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                done = True
+                break
+            if isinstance(item, Exception):
+                print(f'Could not lay out document: {item}')
+                done = True
+                break
+            if isinstance(item, SearchIndex):
+                index = item
+                continue
+            layouts += item
+
+        if layouts:
+            if not job.document.extend(layouts, job.generation):
+                # The document changed since, this job is stale
+                self.cancel()
+                return None
+            redraw.request('content')
+
+        if index is not None:
+            if not job.document.adopt_index(index, job.generation):
+                # The lines changed while they were indexed
+                self.cancel()
+                if job.document.index is None:
+                    self.index(job.document)
+                    return COLLECT_INTERVAL
+                return None
+            document_cache.resize(job.document)
+            redraw.request('content')
+
+        if done:
+            self.job = None
+            self.finished += 1
+            self.last_time = time.perf_counter() - job.started
+            layout_store.save(job.document)
+            return None
+        return COLLECT_INTERVAL
+
+    def reset(self):
+        self.cancel()
+        if bpy.app.timers.is_registered(collect_layouts):
+            bpy.app.timers.unregister(collect_layouts)
+        self.started = 0
+        self.finished = 0
+        self.cancelled = 0
+        self.last_time = 0.0
+
+
+layout_worker = LayoutWorker()
+
+
+def collect_layouts():
+    return layout_worker.collect()
@@ -1,13 +1,30 @@
 import bpy
 from bpy.types import NodeTree
 from bpy.types import Operator
+from bpy.types import Panel
 from bpy.props import PointerProperty
-import blf
+from bpy.props import IntProperty
+from bpy.props import BoolProperty
+from bpy.props import StringProperty
 import os
 
-from . Helpers import menu_func
-from . Properties import DocViewProps
-from . Format import format_text
+from . Helpers import menu_func, view_state
+from . Helpers import get_internal_text, text_signature, cache_dir
+from . Helpers import draw_document, restore_scroll, watch_document
+from . Helpers import find_match, scroll_to_line, draw_outline
+from . Helpers import draw_settings
+from . Redraw import redraw
+from . Properties import DocViewProps, DocViewDocument
+from . Format import format_text, get_font_paths, is_current
+from . Format import update_text
+from . Tabs import document_cache, document_key
+from . Fonts import font_registry
+from . Images import image_cache
+from . Watch import watcher, file_stamp
+from . Worker import layout_worker
+from . Source import open_lines
+from . Store import layout_store
+from . Atlas import glyph_atlas, text_glyphs, highlight_glyphs
 from . Draw import draw_bg, draw_block, draw_image, draw_text
 
 
@@ -57,10 +74,56 @@ class DrawDocument(Operator):
         except ValueError:
             print('Null pointer!')
 
+    def stop(self, context):
+        if getattr(self, 'timer', None) is not None:
+            context.window_manager.event_timer_remove(self.timer)
+            self.timer = None
+
+    # Re-layout the lines of the internal text that changed since
+    # the last look, while the user types in the Text Editor
+    def refresh_internal(self):
+        text = bpy.data.texts.get(self.text_name)
+        if text is None:
+            return
+        signature = text_signature(text)
+        if signature == self.signature:
+            return
+        self.signature = signature
+        update_text(self.document, [line.body for line in text.lines])
+        if self.document.laid_out:
+            redraw.request('content')
+
     def modal(self, context, event):
+        # A newer Draw Document has taken over
+        session = bpy.app.driver_namespace.get('docview_session')
+        if session != self.session:
+            self.stop(context)
+            return {'CANCELLED'}
+
+        if event.type == 'TIMER':
+            if context.scene.docview_props.internal:
+                self.refresh_internal()
+            return {'PASS_THROUGH'}
+
         if context.space_data is not None:
             if context.area.ui_type == 'DocumentViewer':
-                context.area.tag_redraw()
+                # Only redraw when the view actually moved or resized,
+                # not for every mouse move over the area
+                area = context.area
+                state = view_state(area)
+                previous = self.view_states.get(area.as_pointer())
+                if state != previous:
+                    self.view_states[area.as_pointer()] = state
+                    # Resizing moves the view too, as the area is
+                    # resized around its centre, so the width decides
+                    if previous is not None and previous[1] != state[1]:
+                        # Paragraphs are wrapped to the area width
+                        self.document.rewrap((area.width, area.height))
+                        redraw.request('resize')
+                    else:
+                        redraw.request('scroll')
+                else:
+                    redraw.skip()
 
                 if event.type == 'ESC':
                     self.remove_handle()
@@ -72,58 +135,104 @@ class DrawDocument(Operator):
 #                    y = event.mouse_prev_press_y - event.mouse_y
 #                    context.scene.offset_x = x
 #                    context.scene.offset_y = y
-                return {'PASS_THROUGH'}  # do not block execution
 
-        else:
-            return {'PASS_THROUGH'}
+        return {'PASS_THROUGH'}  # do not block execution
 
     def invoke(self, context, event):
         props = context.scene.docview_props
-        regular_path = props.regular_path
-        italic_path = props.italic_path
-        bold_path = props.bold_path
-        code_path = props.code_path
         internal = props.internal
 
         if context.area.ui_type == 'DocumentViewer':
-            if os.path.exists(regular_path):
-                regular = blf.load(regular_path)
-            if os.path.exists(italic_path):
-                italic = blf.load(italic_path)
-            if os.path.exists(bold_path):
-                bold = blf.load(bold_path)
-            if os.path.exists(code_path):
-                code = blf.load(code_path)
-
-            if regular is not None:
-                font_id = regular
-            else:
-                font_id = regular = italic = bold = code = 0 # noqa F841
-
-            fonts = [regular, italic, bold, code]
+            # Loaded once per session, every invoke gets the same ids
+            fonts = font_registry.fonts(get_font_paths(props))
 
             add_draw = bpy.types.SpaceNodeEditor.draw_handler_add
             add_modal = context.window_manager.modal_handler_add
 
-            if not internal:
-                # External File
-                path = props.external_path
-                with open(path) as file:
-                    text = file.read()
-                # To separate external text files into lines
-                text_lines = text.split("\n")
+            # The bundled sample is the first tab
+            if not props.documents:
+                sample = props.documents.add()
+                sample.name = os.path.basename(props.external_path)
+                sample.path = props.external_path
+
+            namespace = bpy.app.driver_namespace
+            document_cache.budget = props.document_budget * 1024 * 1024
+            layout_store.budget = props.store_budget * 1024 * 1024
+            layout_store.folder = cache_dir()
+
+            # Streamed documents are saved with what was laid out of
+            # them when they are left
+            previous_document = namespace.get('docview_document')
+            if previous_document is not None:
+                layout_store.save(previous_document)
+
+            # Remember where the document being replaced was scrolled to
+            previous_key = namespace.get('docview_key')
+            state = view_state(context.area)
+            if previous_key is not None and state is not None:
+                document_cache.save_scroll(previous_key, state[0])
+
+            self.text_name = None
+            self.signature = None
 
             if internal:
                 # Internal File
-                try:
-                    text = bpy.data.texts[0]
-                except IndexError:
-                    bpy.ops.text.new()
-                    text = bpy.data.texts['Text']
-                    text.lines[0].body = '# Check out Markdown in Blender!'
-                text_lines = [line.body for line in text.lines]
-
-            draw_lines, sub_lines, offset_x, offset_y, images, code_blocks, quote_blocks = format_text(context, text_lines, fonts)  # noqa F458
+                text = get_internal_text(props.text_name)
+                key = document_key(True, text.name)
+                stamp = None
+                self.text_name = text.name
+                self.signature = text_signature(text)
+            else:
+                # External File
+                path = props.document_path()
+                key = document_key(False, path)
+                stamp = file_stamp(path)
+                if stamp is None:
+                    # Tabs are saved in the .blend, their file may have
+                    # been moved or deleted since, the tab is closed
+                    self.report({'ERROR'}, f'File not found: {path}')
+                    index = props.active_document
+                    if 0 <= index < len(props.documents):
+                        props.documents.remove(index)
+                        props.active_document = max(
+                            0,
+                            min(index, len(props.documents) - 1)
+                        )
+                    if key != namespace.get('docview_key'):
+                        document_cache.forget(key)
+                    return {'CANCELLED'}
+
+            cached = document_cache.get(key, stamp)
+            unchanged = (
+                cached is not None
+                and stamp is not None
+                and cached.stamp == stamp
+                and cached.document.complete()
+                and is_current(context, cached.document)
+            )
+            if unchanged:
+                # Shown before and nothing changed since, nothing is read
+                document = cached.document
+                images = cached.images
+                document.rewrap((context.area.width, context.area.height))
+            else:
+                if internal:
+                    text_lines = [line.body for line in text.lines]
+                else:
+                    # Lines are read from the file as they are needed,
+                    # only an index of where each one starts is kept
+                    text_lines = open_lines(path, cache_dir())
+                # Reusing the cached document only lays out what changed
+                previous = cached.document if cached is not None else None
+                document, images = format_text(context, text_lines, previous)
+
+            document_cache.put(key, document, images, stamp)
+            namespace['docview_document'] = document
+            namespace['docview_key'] = key
+            self.document = document
+
+            self.session = namespace.get('docview_session', 0) + 1
+            namespace['docview_session'] = self.session
 
             if 'bg_handle' in bpy.app.driver_namespace:
                 self.remove_handle()
@@ -138,34 +247,227 @@ class DrawDocument(Operator):
 
             bpy.app.driver_namespace['block_handle'] = add_draw(
                 draw_block,
-                (self, context, code_blocks, quote_blocks),
+                (self, context, document),
                 'WINDOW',
                 'BACKDROP'
             )
 
             bpy.app.driver_namespace['image_handle'] = add_draw(
                 draw_image,
-                (self, context, images),
+                (self, context, document, images),
                 'WINDOW',
                 'POST_PIXEL'
             )
 
             bpy.app.driver_namespace['text_handle'] = add_draw(
                 draw_text,
-                (self, context, draw_lines, sub_lines, offset_x, offset_y),
+                (self, context, document, fonts),
                 'WINDOW',
                 'POST_PIXEL'  # BACKDROP or POST_PIXEL
             )
 
+            if props.watch_files:
+                watch_document(document, None if internal else path)
+            else:
+                watcher.stop()
+
+            if cached is not None and key != previous_key:
+                restore_scroll(context, cached.scroll)
+
+            self.view_states = {}
+            # key : value
+            # area pointer : view_state of the area at the last event
+
+            redraw.request('content')
+
+            # Polls the internal text for edits
+            self.timer = context.window_manager.event_timer_add(
+                0.2,
+                window=context.window
+            )
+
             add_modal(self)
             return {'RUNNING_MODAL'}
         else:
             return {'CANCELLED'}
 
 
+# Switch to one of the open documents
+class SwitchDocument(Operator):
+    bl_idname = "docview.switch_document"
+    bl_label = "Switch Document"
+
+    index: IntProperty()
+
+    def execute(self, context):
+        props = context.scene.docview_props
+        props.active_document = self.index
+        # Turning internal off draws the document through its update
+        if props.internal:
+            props.internal = False
+        else:
+            draw_document()
+        return {'FINISHED'}
+
+
+# Open a markdown file in a new tab, or switch to it if already open
+class OpenDocument(Operator):
+    bl_idname = "docview.open_document"
+    bl_label = "Open Document"
+
+    filepath: StringProperty(subtype='FILE_PATH')
+
+    filter_glob: StringProperty(
+        default='*.md;*.markdown;*.txt',
+        options={'HIDDEN'}
+    )
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        props = context.scene.docview_props
+        path = os.path.abspath(bpy.path.abspath(self.filepath))
+        if not os.path.isfile(path):
+            self.report({'ERROR'}, f'File not found: {path}')
+            return {'CANCELLED'}
+
+        paths = [
+            os.path.abspath(document.path)
+            for document in props.documents
+        ]
+        if path in paths:
+            props.active_document = paths.index(path)
+        else:
+            document = props.documents.add()
+            document.name = os.path.basename(path)
+            document.path = path
+            props.active_document = len(props.documents) - 1
+        # Turning internal off draws the document through its update
+        if props.internal:
+            props.internal = False
+        else:
+            draw_document()
+        return {'FINISHED'}
+
+
+# Close the tab of the document being shown
+class CloseDocument(Operator):
+    bl_idname = "docview.close_document"
+    bl_label = "Close Document"
+
+    def execute(self, context):
+        props = context.scene.docview_props
+        index = props.active_document
+        if not 0 <= index < len(props.documents):
+            return {'CANCELLED'}
+        path = props.documents[index].path
+        props.documents.remove(index)
+        props.active_document = max(0, min(index, len(props.documents) - 1))
+        draw_document()
+
+        key = document_key(False, path)
+        if key != bpy.app.driver_namespace.get('docview_key'):
+            document_cache.forget(key)
+        return {'FINISHED'}
+
+
+# Scroll to the next, or previous, line matching the search
+class FindMatch(Operator):
+    bl_idname = "docview.find_match"
+    bl_label = "Find Match"
+
+    backward: BoolProperty()
+
+    def execute(self, context):
+        document = bpy.app.driver_namespace.get('docview_document')
+        if document is None:
+            return {'CANCELLED'}
+        index = find_match(context.area, document, self.backward)
+        if index is None:
+            self.report({'INFO'}, 'No matches')
+            return {'CANCELLED'}
+        scroll_to_line(context.area, document, index)
+        redraw.request('scroll')
+        return {'FINISHED'}
+
+
+# Fold, or unfold, the section under a heading of the outline
+class ToggleSection(Operator):
+    bl_idname = "docview.toggle_section"
+    bl_label = "Toggle Section"
+
+    index: IntProperty()
+
+    def execute(self, context):
+        document = bpy.app.driver_namespace.get('docview_document')
+        if document is None or not 0 <= self.index < len(document.outline):
+            return {'CANCELLED'}
+        document.toggle_section(self.index)
+        redraw.request('content')
+        return {'FINISHED'}
+
+
+# Scroll to a heading of the outline
+class JumpToHeading(Operator):
+    bl_idname = "docview.jump_to_heading"
+    bl_label = "Jump To Heading"
+
+    index: IntProperty()
+
+    def execute(self, context):
+        document = bpy.app.driver_namespace.get('docview_document')
+        if document is None or not 0 <= self.index < len(document.outline):
+            return {'CANCELLED'}
+        line = document.outline.lines[self.index]
+        scroll_to_line(context.area, document, line)
+        redraw.request('scroll')
+        return {'FINISHED'}
+
+
+class DocumentOutline(Panel):
+    bl_idname = "DOCVIEW_PT_outline"
+    bl_label = "Outline"
+    bl_space_type = 'NODE_EDITOR'
+    bl_region_type = 'UI'
+    bl_category = "Outline"
+
+    @classmethod
+    def poll(cls, context):
+        return context.area.ui_type == 'DocumentViewer'
+
+    def draw(self, context):
+        draw_outline(self.layout, context)
+
+
+class DocumentSettings(Panel):
+    bl_idname = "DOCVIEW_PT_settings"
+    bl_label = "Settings"
+    bl_space_type = 'NODE_EDITOR'
+    bl_region_type = 'UI'
+    bl_category = "Settings"
+
+    @classmethod
+    def poll(cls, context):
+        return context.area.ui_type == 'DocumentViewer'
+
+    def draw(self, context):
+        draw_settings(self.layout, context)
+
+
 classes = [
     DrawDocument,
+    FindMatch,
+    ToggleSection,
+    JumpToHeading,
+    DocumentOutline,
+    DocumentSettings,
+    SwitchDocument,
+    OpenDocument,
+    CloseDocument,
     DocumentViewer,
+    DocViewDocument,
     DocViewProps
 ]
 
@@ -180,6 +482,10 @@ def register():
 
 
 def unregister():
+    document = bpy.app.driver_namespace.get('docview_document')
+    if document is not None:
+        layout_store.save(document)
+
     from bpy.utils import unregister_class
     for cls in reversed(classes):
         unregister_class(cls)
@@ -187,6 +493,17 @@ def unregister():
     del bpy.types.Scene.docview_props
     bpy.types.NODE_MT_editor_menus.remove(menu_func)
 
+    watcher.reset()
+    layout_worker.reset()
+    document_cache.clear()
+    layout_store.reset()
+    image_cache.clear()
+    text_glyphs.clear()
+    highlight_glyphs.clear()
+    glyph_atlas.reset()
+    redraw.reset()
+    font_registry.unload()
+
 
 if __name__ == "__main__":
     register()